@@ -1,15 +1,25 @@
+import time
+_PROCESS_STARTED = time.perf_counter()
+
 import os
+import re
 import shutil
 import logging
 import sqlite3
 from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
-from config import UPLOADS_FOLDER, VECTOR_STORES_FOLDER
-from utils import process_and_index_pdf
-from rag_chain import get_conversational_chain,  get_general_ai_chain 
-from langchain.memory import ConversationBufferMemory
+from config import (
+    UPLOADS_FOLDER, VECTOR_STORES_FOLDER, WARMUP_ON_STARTUP, BATCH_MAX_QUESTIONS, BATCH_LLM_CONCURRENCY,
+    PDF_CACHE_MAX_AGE, PAGE_PREVIEW_DPI, PAGE_PREVIEW_MAX_DPI
+)
+from utils import process_and_index_pdf, remove_unreferenced_store, remove_stale_temp_stores, render_pdf_page, get_pdf_page_text
+import manifest
+from rag_chain import get_conversational_chain,  get_general_ai_chain, answer_questions_batch
 from langchain_core.messages import HumanMessage, AIMessage
 from database import init_db, DATABASE_NAME
+from vector_index import evict_category, resolve_filters
+from llm_gateway import get_llm_gateway, QueueFullError
+from warmup import start_warmup, get_readiness
 import uuid
 import sys
 import io
@@ -30,8 +40,69 @@ logging.basicConfig(
 SESSIONS = {}
 init_db()
 logger = logging.getLogger(__name__)
+if os.path.exists(VECTOR_STORES_FOLDER):
+    for _category in os.listdir(VECTOR_STORES_FOLDER):
+        remove_stale_temp_stores(_category)
 app = Flask(__name__)
-CORS(app)
+# the pdf viewer reads these when it requests byte ranges cross-origin
+CORS(app, expose_headers=['Accept-Ranges', 'Content-Range', 'Content-Length', 'ETag', 'Last-Modified'])
+_first_answer_logged = False
+logger.info(f"Application modules imported in {time.perf_counter() - _PROCESS_STARTED:.2f}s")
+
+def parse_answer_and_citations(raw_answer, num_documents):
+    # If it's an AIMessage object, extract the content
+    if hasattr(raw_answer, 'content'):
+        answer_text = raw_answer.content
+    elif isinstance(raw_answer, str):
+        answer_text = raw_answer
+    else:
+        answer_text = str(raw_answer)
+
+    # Parse citations from answer
+    citation_match = re.search(r'SOURCES:\s*\[([\d,\s]+)\]', answer_text)
+    
+    if citation_match:
+        cited_nums = [int(n.strip()) for n in citation_match.group(1).split(',') if n.strip()]
+        answer = re.sub(r'\n?SOURCES:.*$', '', answer_text).strip()
+    else:
+        cited_nums = list(range(1, num_documents + 1))
+        answer = answer_text
+    return answer, cited_nums
+
+def build_sources(cited_nums, source_documents):
+    sources = []
+    for doc_num in cited_nums:
+        if 0 < doc_num <= len(source_documents):
+            doc = source_documents[doc_num - 1]  # Convert to 0-based index
+            source_file = doc.metadata.get("source", "Unknown")
+            page_num = doc.metadata.get("page", -1)
+            page_label = page_num + 1 if page_num != -1 else "N/A"
+            source_text = doc.page_content if hasattr(doc, 'page_content') else ""
+            
+            sources.append({
+                "source": os.path.basename(source_file),
+                "page": page_label,
+                "text": source_text,
+                "citation_number": doc_num
+            })
+    return sources
+
+def queue_full_response(error):
+    logger.warning(f"Rejected LLM request: {error}")
+    response = jsonify({"error": "The AI service is busy. Please try again shortly.", "retry_after": error.retry_after})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 429
+
+#LLM gateway metrics API Endpoint
+@app.route('/metrics/llm', methods=['GET'])
+def llm_metrics_handler():
+    return jsonify(get_llm_gateway().stats()), 200
+
+#readiness API Endpoint
+@app.route('/health/ready', methods=['GET'])
+def readiness_handler():
+    ready, components = get_readiness()
+    return jsonify({"ready": ready, "components": components}), 200 if ready else 503
 
 #general chat API Endpoint 
 @app.route('/ai-solution', methods=['POST'])
@@ -52,6 +123,8 @@ def ai_solution_handler():
         ai_answer = response      
         logger.info("Successfully generated general AI response.")
         return jsonify({"answer": ai_answer})
+    except QueueFullError as e:
+        return queue_full_response(e)
     except Exception as e:
         logger.error(f"Error in general AI chain: {e}")
         return jsonify({"error": "Failed to generate AI response."}), 500
@@ -89,7 +162,6 @@ def delete_document_handler(category, filename):
     logger.info(f"Request to delete document '{filename}' from category '{category}'.")
     pdf_path = os.path.join(UPLOADS_FOLDER, category, filename)
     pdf_name_without_ext = os.path.splitext(filename)[0]
-    vector_store_path = os.path.join(VECTOR_STORES_FOLDER, category, pdf_name_without_ext)
     pdf_deleted = False
     vector_store_deleted = False
 
@@ -101,14 +173,18 @@ def delete_document_handler(category, filename):
         else:
             logger.warning(f"PDF file not found, could not delete: {pdf_path}")
 
-        if os.path.exists(vector_store_path):
-            shutil.rmtree(vector_store_path)
-            vector_store_deleted = True
-            logger.info(f"Successfully deleted vector store: {vector_store_path}")
+        # the store is shared by identical uploads, so only drop it once unreferenced
+        store_name = manifest.remove_document(category, pdf_name_without_ext)
+        if store_name:
+            vector_store_deleted = remove_unreferenced_store(category, store_name)
+            if vector_store_deleted:
+                logger.info(f"Successfully deleted vector store '{store_name}' for '{filename}'.")
+            else:
+                logger.info(f"Vector store '{store_name}' is still used by other documents. Keeping it.")
         else:
-            logger.warning(f"Vector store not found, could not delete: {vector_store_path}")
+            logger.warning(f"No vector store registered for '{filename}' in category '{category}'.")
 
-        if not pdf_deleted and not vector_store_deleted:
+        if not pdf_deleted and not store_name:
             return jsonify({"error": "File and vector store not found."}), 404
 
         return jsonify({
@@ -161,6 +237,8 @@ def delete_category_handler(category_id):
             shutil.rmtree(upload_path)
         if os.path.exists(vector_store_path):
             shutil.rmtree(vector_store_path)
+        evict_category(category_id)
+        manifest.forget(category_id)
         
         logger.info(f"Successfully deleted category '{category_id}'.")
         return jsonify({"message": f"Category '{category_id}' deleted successfully."}), 200
@@ -194,8 +272,16 @@ def chat_handler():
     category = session_info.get('category')
 
     try:
+        filters = resolve_filters(category, data.get('filters'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        # reject early so an overloaded LLM doesn't leave unanswered questions in the history
+        get_llm_gateway().check_admission()
+
         # start rag chain
-        rag_chain = get_conversational_chain(category)
+        rag_chain = get_conversational_chain(category, filters)
         if not rag_chain:
             return jsonify({"error": f"Could not create RAG chain for category '{category}'."}), 500
 
@@ -231,24 +317,7 @@ def chat_handler():
         source_documents = result.get("docs", [])
         raw_answer = result.get("answer", "Error: The model failed to generate an answer.")
 
-        # If it's an AIMessage object, extract the content
-        if hasattr(raw_answer, 'content'):
-            answer_text = raw_answer.content
-        elif isinstance(raw_answer, str):
-            answer_text = raw_answer
-        else:
-            answer_text = str(raw_answer)
-
-        # Parse citations from answer
-        import re
-        citation_match = re.search(r'SOURCES:\s*\[([\d,\s]+)\]', answer_text)
-        
-        if citation_match:
-            cited_nums = [int(n.strip()) for n in citation_match.group(1).split(',')]
-            answer = re.sub(r'\n?SOURCES:.*$', '', answer_text).strip()
-        else:
-            cited_nums = list(range(1, len(source_documents) + 1))
-            answer = answer_text
+        answer, cited_nums = parse_answer_and_citations(raw_answer, len(source_documents))
 
         # save AI answer to DB
         cursor.execute(
@@ -260,30 +329,81 @@ def chat_handler():
         conn.close() 
         
         # send to the frontend
-        sources = []
-        for doc_num in cited_nums:
-            if 0 < doc_num <= len(source_documents):
-                doc = source_documents[doc_num - 1]  # Convert to 0-based index
-                source_file = doc.metadata.get("source", "Unknown")
-                page_num = doc.metadata.get("page", -1)
-                page_label = page_num + 1 if page_num != -1 else "N/A"
-                source_text = doc.page_content if hasattr(doc, 'page_content') else ""
-                
-                sources.append({
-                    "source": os.path.basename(source_file),
-                    "page": page_label,
-                    "text": source_text,
-                    "citation_number": doc_num
-                })
+        sources = build_sources(cited_nums, source_documents)
         
+        global _first_answer_logged
+        if not _first_answer_logged:
+            _first_answer_logged = True
+            logger.info(f"Time to first answer: {time.perf_counter() - _PROCESS_STARTED:.2f}s after process start")
+
         logger.info(f"Responded to question in '{category}'. Cited {len(sources)} sources: {cited_nums}")
         logger.info(f"Answer: {answer[:100]}... | Sources: {sources}")
         return jsonify({"answer": answer, "sources": sources})
 
+    except QueueFullError as e:
+        return queue_full_response(e)
     except Exception as e:
         logger.error(f"Critical error in chat handler for category '{category}': {e}", exc_info=True)
         return jsonify({"error": "An internal server error occurred."}), 500
     
+#batch chat API endpoint
+@app.route('/chat/batch', methods=['POST'])
+def chat_batch_handler():
+    data = request.json
+    category = data.get('category')
+    questions = data.get('questions')
+    if not category or not isinstance(questions, list) or not questions:
+        return jsonify({"error": "A 'category' and a non-empty 'questions' list are required."}), 400
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        return jsonify({"error": f"At most {BATCH_MAX_QUESTIONS} questions are allowed per batch."}), 400
+    try:
+        max_concurrency = max(1, min(int(data.get('max_concurrency', BATCH_LLM_CONCURRENCY)), BATCH_LLM_CONCURRENCY))
+    except (TypeError, ValueError):
+        return jsonify({"error": "'max_concurrency' must be an integer."}), 400
+    try:
+        filters = resolve_filters(category, data.get('filters'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    valid = [(i, q) for i, q in enumerate(questions) if isinstance(q, str) and q.strip()]
+    results = [{"index": i, "question": q, "error": "Question must be a non-empty string."} for i, q in enumerate(questions)]
+    if not valid:
+        return jsonify({"results": results, "stats": {"questions": len(questions), "failed": len(questions)}}), 200
+
+    try:
+        started = time.perf_counter()
+        batch_results, timings = answer_questions_batch(category, [q for _, q in valid], max_concurrency, filters)
+        if batch_results is None:
+            return jsonify({"error": f"Could not load vector stores for category '{category}'."}), 500
+        elapsed = time.perf_counter() - started
+
+        for (index, question), item in zip(valid, batch_results):
+            if 'error' in item:
+                results[index] = {"index": index, "question": question, "error": item['error']}
+                continue
+            answer, cited_nums = parse_answer_and_citations(item['answer'], len(item['docs']))
+            results[index] = {
+                "index": index,
+                "question": question,
+                "answer": answer,
+                "sources": build_sources(cited_nums, item['docs'])
+            }
+
+        failed = sum(1 for r in results if 'error' in r)
+        stats = {
+            "questions": len(questions),
+            "failed": failed,
+            "elapsed_seconds": round(elapsed, 3),
+            "questions_per_second": round(len(valid) / elapsed, 3) if elapsed > 0 else None,
+            "stage_seconds": {stage: round(seconds, 3) for stage, seconds in timings.items()}
+        }
+        logger.info(f"Answered batch of {len(questions)} question(s) in '{category}' ({failed} failed). Stats: {stats}")
+        return jsonify({"results": results, "stats": stats}), 200
+
+    except Exception as e:
+        logger.error(f"Critical error in batch chat handler for category '{category}': {e}", exc_info=True)
+        return jsonify({"error": "An internal server error occurred."}), 500
+    
 #chat history fetch API Endpoint
 @app.route('/chat/history/<string:category>', methods=['GET'])
 def get_chat_history_handler(category):
@@ -324,38 +444,93 @@ def delete_chat_session_handler(category):
         logger.error(f"Error deleting chat session '{category}': {e}", exc_info=True)
         return jsonify({"error": "Failed to delete chat session."}), 500
 
+def resolve_pdf_path(category, filename):
+    pdf_path = os.path.join(UPLOADS_FOLDER, category, filename)
+    return pdf_path if pdf_path.lower().endswith('.pdf') else pdf_path + '.pdf'
+
 # PDF serving API Endpoint
 @app.route('/pdf/<string:category>/<string:filename>', methods=['GET'])
 def serve_pdf(category, filename):
     try:
-        pdf_path = os.path.join(UPLOADS_FOLDER, category, filename)
-        pdf_path = pdf_path if pdf_path.lower().endswith('.pdf') else pdf_path + '.pdf'
-        logger.info(f"Attempting to serve PDF: {pdf_path}")
-        
+        pdf_path = resolve_pdf_path(category, filename)
         
         if not os.path.exists(pdf_path):
             logger.error(f"PDF not found at path: {pdf_path}")
-            
-           
-            category_path = os.path.join(UPLOADS_FOLDER, category)
-            if os.path.exists(category_path):
-                available_files = os.listdir(category_path)
-                logger.error(f"Available files in {category}: {available_files}")
-            
             return jsonify({'error': 'PDF file not found', 'path': pdf_path}), 404
         
-        logger.info(f"Successfully serving PDF: {filename}")
-        return send_file(
+        # conditional responses handle Range (206) and If-None-Match/If-Modified-Since (304)
+        response = send_file(
             pdf_path,
             mimetype='application/pdf',
             as_attachment=False,
-            download_name=filename
+            download_name=os.path.basename(pdf_path),
+            conditional=True,
+            etag=True,
+            max_age=PDF_CACHE_MAX_AGE
         )
+        response.headers['Accept-Ranges'] = 'bytes'
+        logger.info(f"Serving PDF {filename} with status {response.status_code}")
+        return response
        
     except Exception as e:
         logger.error(f"Error serving PDF {filename}: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+# PDF page preview API Endpoint
+@app.route('/pdf/<string:category>/<string:filename>/pages/<int:page>', methods=['GET'])
+def serve_pdf_page(category, filename, page):
+    output_format = request.args.get('format', 'png')
+    if output_format not in ('png', 'text'):
+        return jsonify({'error': "format must be 'png' or 'text'"}), 400
+    try:
+        dpi = min(max(int(request.args.get('dpi', PAGE_PREVIEW_DPI)), 36), PAGE_PREVIEW_MAX_DPI)
+    except ValueError:
+        return jsonify({'error': 'dpi must be an integer'}), 400
+
+    try:
+        pdf_path = resolve_pdf_path(category, filename)
+        if not os.path.exists(pdf_path):
+            logger.error(f"PDF not found at path: {pdf_path}")
+            return jsonify({'error': 'PDF file not found', 'path': pdf_path}), 404
+
+        # the page depends only on the file version and render options
+        stat = os.stat(pdf_path)
+        etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}-{page}-{output_format}-{dpi}"
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            response.cache_control.public = True
+            response.cache_control.max_age = PDF_CACHE_MAX_AGE
+            return response
+
+        if output_format == 'png':
+            body = render_pdf_page(pdf_path, page, dpi)
+            mimetype = 'image/png'
+        else:
+            body = get_pdf_page_text(pdf_path, page)
+            mimetype = 'text/plain; charset=utf-8'
+        if body is None:
+            return jsonify({'error': f'Page {page} does not exist'}), 404
+
+        response = app.response_class(body, mimetype=mimetype)
+        response.set_etag(etag)
+        response.last_modified = stat.st_mtime
+        response.cache_control.public = True
+        response.cache_control.max_age = PDF_CACHE_MAX_AGE
+        return response
+
+    except Exception as e:
+        logger.error(f"Error serving page {page} of PDF {filename}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 if __name__ == '__main__':
     logger.info("Starting Flask application")
-    app.run(host='0.0.0.0', port=5000, debug=True, threaded=False)
\ No newline at end of file
+    debug = True
+    # with the debug reloader only the serving child process should warm up
+    if WARMUP_ON_STARTUP and (not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+        start_warmup()
+    # requests must run concurrently for the LLM gateway to prioritise /chat over
+    # /chat/batch and to reject overload with 429; the gateway, not the server,
+    # bounds concurrent LLM calls. Under a WSGI server use threaded workers
+    # (e.g. gunicorn --threads) rather than single-threaded processes.
+    app.run(host='0.0.0.0', port=5000, debug=debug, threaded=True)
\ No newline at end of file
@@ -14,5 +14,63 @@ RETRIEVER_K = 5
 TESSERACT_PATH = r"C:\Program Files\Tesseract-OCR\tesseract.exe"  
 OCR_LANGUAGES = "eng+ben"  
 OCR_CONFIDENCE_THRESHOLD = 60 
+OCR_DPI = 300
 
-POPPLER_PATH = r"C:\Program Files\poppler-25.07.0\Library\bin"
\ No newline at end of file
+# per-page PyMuPDF/OCR text keyed by PDF content hash and extraction settings
+EXTRACTION_CACHE_DB = os.path.join(BASE_DIR, 'extraction_cache.db')
+
+POPPLER_PATH = r"C:\Program Files\poppler-25.07.0\Library\bin"
+
+# preload the embedder, reranker and the most used category indexes in the
+# background at startup; readiness is reported on /health/ready
+WARMUP_ON_STARTUP = True
+WARMUP_TOP_CATEGORIES = 3
+
+# token budget for the retrieved context sent to the LLM; tokens are
+# estimated from UTF-8 bytes
+CONTEXT_TOKEN_BUDGET = 3000
+CONTEXT_BYTES_PER_TOKEN = 4
+
+# /chat/batch limits; reranking is CPU-bound at ~0.4-0.5s per (question,
+# chunk) pair, so 100 questions keep one call to a few minutes
+BATCH_MAX_QUESTIONS = 100
+BATCH_LLM_CONCURRENCY = 8
+# (question, chunk) pairs scored per reranker call, across questions. One
+# pair per call was fastest on CPU; larger calls only pay off with many
+# cores or a GPU and need ~30MB of memory per 512-token pair
+RERANK_BATCH_PAIRS = 1
+
+# PDF serving: Cache-Control max-age in seconds and page preview render DPI
+PDF_CACHE_MAX_AGE = 3600
+PAGE_PREVIEW_DPI = 100
+PAGE_PREVIEW_MAX_DPI = 300
+
+# reindex.py: number of chunks embedded per call across PDFs
+BULK_EMBED_BATCH_SIZE = 1024
+
+# LLM gateway: 'openai' or 'stub' (a local fake model for testing)
+LLM_BACKEND = os.environ.get('LLM_BACKEND', 'openai')
+LLM_MAX_CONCURRENCY = 4
+# waiting calls allowed per priority: interactive /chat and batch items have
+# separate budgets so batch jobs can't crowd out /chat; a batch item that
+# finds its budget full waits up to the admission timeout for a place
+LLM_MAX_QUEUE_DEPTH = 32
+LLM_MAX_BATCH_QUEUE_DEPTH = 16
+LLM_BATCH_ADMISSION_TIMEOUT_SECONDS = 600
+# seconds before a hung provider call is abandoned and retried by the gateway
+LLM_REQUEST_TIMEOUT_SECONDS = 60
+LLM_MAX_RETRIES = 3
+LLM_BACKOFF_BASE_SECONDS = 0.5
+LLM_BACKOFF_MAX_SECONDS = 8
+
+# near-duplicate chunks (SimHash within this many differing bits) are dropped
+# within a document before embedding, and collapsed in retrieval results
+# before reranking. Duplicates across documents, such as two editions of a
+# PDF, are linked to the store that already holds them instead of being
+# embedded again; that store is kept while a linking document remains. At 7
+# bits, 100-300 word chunks with ~1% of words or a page number changed
+# match ~97-99% of the time; chunks sharing only the 300-char overlap match
+# <0.5% of the time and unrelated chunks never did.
+NEAR_DUPLICATE_DETECTION = True
+NEAR_DUPLICATE_MAX_HAMMING = 7
+NEAR_DUPLICATE_FETCH_FACTOR = 3
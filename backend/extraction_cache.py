@@ -0,0 +1,104 @@
+import base64
+import sqlite3
+import logging
+import zlib
+from config import EXTRACTION_CACHE_DB, OCR_LANGUAGES, OCR_CONFIDENCE_THRESHOLD, OCR_DPI
+
+logger = logging.getLogger(__name__)
+
+PYMUPDF_SETTINGS = 'default'
+
+def ocr_settings_key():
+    # any change to these invalidates cached OCR text
+    return f"lang={OCR_LANGUAGES};conf={OCR_CONFIDENCE_THRESHOLD};dpi={OCR_DPI}"
+
+def _connect():
+    conn = sqlite3.connect(EXTRACTION_CACHE_DB, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS page_text (
+        content_hash TEXT NOT NULL,
+        page INTEGER NOT NULL,
+        method TEXT NOT NULL, -- 'pymupdf' or 'ocr'
+        settings TEXT NOT NULL,
+        text BLOB NOT NULL, -- zlib-compressed UTF-8
+        PRIMARY KEY (content_hash, method, settings, page)
+    ) WITHOUT ROWID;""")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS page_counts (
+        content_hash TEXT NOT NULL,
+        method TEXT NOT NULL,
+        settings TEXT NOT NULL,
+        page_count INTEGER NOT NULL,
+        PRIMARY KEY (content_hash, method, settings)
+    ) WITHOUT ROWID;""")
+    return conn
+
+def get_pages(content_hash, method, settings):
+    """Returns ({page: text}, page_count) for the cached pages; page_count is None until all pages are stored."""
+    try:
+        conn = _connect()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT page, text FROM page_text WHERE content_hash = ? AND method = ? AND settings = ?",
+            (content_hash, method, settings)
+        )
+        pages = {page: zlib.decompress(text).decode('utf-8') for page, text in cursor.fetchall()}
+        cursor.execute(
+            "SELECT page_count FROM page_counts WHERE content_hash = ? AND method = ? AND settings = ?",
+            (content_hash, method, settings)
+        )
+        row = cursor.fetchone()
+        conn.close()
+        return pages, row[0] if row else None
+    except Exception as e:
+        logger.warning(f"Could not read extraction cache for {content_hash[:12]}: {e}")
+        return {}, None
+
+def put_pages(content_hash, method, settings, pages, page_count=None):
+    """Stores {page: text}; pass page_count once every page of the PDF has been stored."""
+    try:
+        conn = _connect()
+        conn.executemany(
+            "INSERT OR REPLACE INTO page_text (content_hash, page, method, settings, text) VALUES (?, ?, ?, ?, ?)",
+            [(content_hash, page, method, settings, zlib.compress(text.encode('utf-8'))) for page, text in pages.items()]
+        )
+        if page_count is not None:
+            conn.execute(
+                "INSERT OR REPLACE INTO page_counts (content_hash, method, settings, page_count) VALUES (?, ?, ?, ?)",
+                (content_hash, method, settings, page_count)
+            )
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.warning(f"Could not write extraction cache for {content_hash[:12]}: {e}")
+
+def export_rows(content_hashes):
+    """Yields every cached row for the given PDFs as JSON-ready dicts, text kept compressed."""
+    conn = _connect()
+    cursor = conn.cursor()
+    for content_hash in content_hashes:
+        cursor.execute("SELECT page, method, settings, text FROM page_text WHERE content_hash = ?", (content_hash,))
+        for page, method, settings, text in cursor.fetchall():
+            yield {'content_hash': content_hash, 'page': page, 'method': method, 'settings': settings,
+                   'text': base64.b64encode(text).decode('ascii')}
+        cursor.execute("SELECT method, settings, page_count FROM page_counts WHERE content_hash = ?", (content_hash,))
+        for method, settings, page_count in cursor.fetchall():
+            yield {'content_hash': content_hash, 'method': method, 'settings': settings, 'page_count': page_count}
+    conn.close()
+
+def import_rows(rows):
+    conn = _connect()
+    for row in rows:
+        if 'page_count' in row:
+            conn.execute(
+                "INSERT OR REPLACE INTO page_counts (content_hash, method, settings, page_count) VALUES (?, ?, ?, ?)",
+                (row['content_hash'], row['method'], row['settings'], row['page_count'])
+            )
+        else:
+            conn.execute(
+                "INSERT OR REPLACE INTO page_text (content_hash, page, method, settings, text) VALUES (?, ?, ?, ?, ?)",
+                (row['content_hash'], row['page'], row['method'], row['settings'], base64.b64decode(row['text']))
+            )
+    conn.commit()
+    conn.close()
@@ -0,0 +1,173 @@
+import heapq
+import itertools
+import logging
+import math
+import random
+import threading
+import time
+from collections import deque
+from config import (
+    LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE_DEPTH, LLM_MAX_BATCH_QUEUE_DEPTH, LLM_MAX_RETRIES,
+    LLM_BACKOFF_BASE_SECONDS, LLM_BACKOFF_MAX_SECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+# lower value is served first
+INTERACTIVE = 0
+BATCH = 1
+
+RETRYABLE_ERRORS = {'RateLimitError', 'APITimeoutError', 'APIConnectionError', 'InternalServerError', 'Timeout'}
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"LLM queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+def is_retryable(error):
+    if type(error).__name__ in RETRYABLE_ERRORS:
+        return True
+    return getattr(error, 'status_code', None) in RETRYABLE_STATUS_CODES
+
+
+class LLMGateway:
+    """Admission control in front of the LLM: a concurrency limit, a priority queue and retries.
+
+    Each priority has its own queue depth budget, so batch work can never take
+    the places interactive callers need. A caller that finds its budget used
+    up is rejected with QueueFullError instead of piling up until it times
+    out, unless it passes admission_timeout to wait that long for a place.
+    """
+
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, max_queue_depth=LLM_MAX_QUEUE_DEPTH,
+                 max_batch_queue_depth=LLM_MAX_BATCH_QUEUE_DEPTH, max_retries=LLM_MAX_RETRIES,
+                 backoff_base=LLM_BACKOFF_BASE_SECONDS, backoff_max=LLM_BACKOFF_MAX_SECONDS,
+                 retryable=is_retryable):
+        self.max_concurrency = max_concurrency
+        self.max_queue_depth = max_queue_depth
+        self.max_batch_queue_depth = max_batch_queue_depth
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retryable = retryable
+
+        self._cond = threading.Condition()
+        self._queue = []  # heap of (priority, sequence) tickets
+        self._sequence = itertools.count()
+        self._queued = {INTERACTIVE: 0, BATCH: 0}
+        self._active = 0
+        self._queue_waits = deque(maxlen=1000)
+        self._call_durations = deque(maxlen=100)
+        self._counters = {'completed': 0, 'failed': 0, 'rejected': 0, 'retries': 0}
+
+    def _count(self, name):
+        with self._cond:
+            self._counters[name] += 1
+
+    def _retry_after(self):
+        # rough time until the queue drains, from recent call durations
+        average = sum(self._call_durations) / len(self._call_durations) if self._call_durations else 1.0
+        return max(1, math.ceil(len(self._queue) / self.max_concurrency * average))
+
+    def _depth_limit(self, priority):
+        return self.max_batch_queue_depth if priority == BATCH else self.max_queue_depth
+
+    def _is_full(self, priority):
+        return self._queued[priority] >= self._depth_limit(priority)
+
+    def check_admission(self, priority=INTERACTIVE):
+        with self._cond:
+            if self._is_full(priority):
+                self._counters['rejected'] += 1
+                raise QueueFullError(self._retry_after())
+
+    def _acquire(self, priority, admission_timeout=None):
+        with self._cond:
+            started = time.monotonic()
+            if self._is_full(priority):
+                if not admission_timeout:
+                    self._counters['rejected'] += 1
+                    raise QueueFullError(self._retry_after())
+                # wait for a place in this priority's budget instead of failing
+                if not self._cond.wait_for(lambda: not self._is_full(priority), admission_timeout):
+                    self._counters['rejected'] += 1
+                    raise QueueFullError(self._retry_after())
+
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(self._queue, ticket)
+            self._queued[priority] += 1
+            while self._active >= self.max_concurrency or self._queue[0] != ticket:
+                self._cond.wait()
+            heapq.heappop(self._queue)
+            self._queued[priority] -= 1
+            self._active += 1
+            # let the next ticket in line check for a free slot
+            self._cond.notify_all()
+
+            waited = time.monotonic() - started
+            self._queue_waits.append(waited)
+
+        if waited > 1:
+            logger.info(f"LLM call waited {waited:.2f}s in the queue (priority {priority}).")
+
+    def _release(self, duration):
+        with self._cond:
+            self._active -= 1
+            self._call_durations.append(duration)
+            self._cond.notify_all()
+
+    def call(self, fn, *args, priority=INTERACTIVE, admission_timeout=None, **kwargs):
+        self._acquire(priority, admission_timeout)
+        started = time.monotonic()
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    result = fn(*args, **kwargs)
+                    self._count('completed')
+                    return result
+                except Exception as e:
+                    if attempt == self.max_retries or not self.retryable(e):
+                        self._count('failed')
+                        raise
+                    # full jitter keeps retries from stampeding the provider together
+                    delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                    self._count('retries')
+                    logger.warning(f"LLM call failed ({type(e).__name__}), retry {attempt + 1}/{self.max_retries} in {delay:.2f}s")
+                    time.sleep(delay)
+        finally:
+            self._release(time.monotonic() - started)
+
+    def stats(self):
+        with self._cond:
+            waits = sorted(self._queue_waits)
+            stats = {
+                'active': self._active,
+                'queued': len(self._queue),
+                'queued_interactive': self._queued[INTERACTIVE],
+                'queued_batch': self._queued[BATCH],
+                'max_concurrency': self.max_concurrency,
+                'max_queue_depth': self.max_queue_depth,
+                'max_batch_queue_depth': self.max_batch_queue_depth,
+                **self._counters,
+            }
+        stats['queue_wait_seconds'] = {
+            'avg': round(sum(waits) / len(waits), 4) if waits else 0.0,
+            'p95': round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 4) if waits else 0.0,
+            'max': round(waits[-1], 4) if waits else 0.0,
+        }
+        return stats
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+def get_llm_gateway():
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = LLMGateway()
+    return _gateway
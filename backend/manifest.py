@@ -0,0 +1,244 @@
+import os
+import json
+import logging
+import threading
+import itertools
+import uuid
+from config import VECTOR_STORES_FOLDER
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = '_manifest.jsonl'
+LEGACY_MAPPING_FILENAME = '_name_mapping.json'
+
+# per-category view of the manifest, kept in sync by reading only the bytes
+# appended since the last refresh
+_manifests = {}
+_lock = threading.RLock()
+_serials = itertools.count()
+
+
+class _CategoryManifest:
+    def __init__(self):
+        self.serial = next(_serials)
+        self.offset = 0
+        self.file_id = None  # (st_dev, st_ino) of the file the offset belongs to
+        self.header = None   # first line of that file, a generation record for new manifests
+        self.documents = {}       # original pdf name -> store name
+        self.stores_by_hash = {}  # content hash -> store name
+        self.names_by_store = {}  # store name -> set of original pdf names
+        self.links_by_store = {}  # store name -> stores holding the canonical copies of its linked chunks
+
+    def apply(self, record):
+        op = record.get('op')
+        name = record.get('name')
+        if op == 'add':
+            store = record['store']
+            self.add(name, store, record.get('content_hash'))
+            if record.get('links'):
+                self.links_by_store.setdefault(store, set()).update(record['links'])
+            # a rebuilt store takes over every name of the store it replaces in the same record,
+            # and the chunks linked into the old store now resolve against the new one
+            replaced = record.get('replaces')
+            if replaced and replaced != store:
+                for other in list(self.names_by_store.get(replaced, ())):
+                    self.add(other, store, record.get('content_hash'))
+                for linking_store, targets in self.links_by_store.items():
+                    if replaced in targets and linking_store != store:
+                        targets.discard(replaced)
+                        targets.add(store)
+        elif op == 'remove':
+            self.discard(name)
+
+    def add(self, name, store, content_hash):
+        self.discard(name)
+        self.documents[name] = store
+        self.names_by_store.setdefault(store, set()).add(name)
+        if content_hash:
+            self.stores_by_hash[content_hash] = store
+
+    def discard(self, name):
+        store = self.documents.pop(name, None)
+        if store is None:
+            return
+        names = self.names_by_store.get(store, set())
+        names.discard(name)
+        if not names:
+            self.names_by_store.pop(store, None)
+            for content_hash in [h for h, s in self.stores_by_hash.items() if s == store]:
+                del self.stores_by_hash[content_hash]
+
+    def linked_stores(self):
+        # only stores that still have a document keep their link targets alive
+        return {target for store in self.names_by_store for target in self.links_by_store.get(store, ())}
+
+
+def _manifest_path(category):
+    return os.path.join(VECTOR_STORES_FOLDER, category, MANIFEST_FILENAME)
+
+def _load_legacy_mapping(category, manifest):
+    mapping_file = os.path.join(VECTOR_STORES_FOLDER, category, LEGACY_MAPPING_FILENAME)
+    if not os.path.exists(mapping_file):
+        return
+    try:
+        with open(mapping_file, 'r', encoding='utf-8') as f:
+            mappings = json.load(f)
+        for sanitized_name, original_name in mappings.items():
+            manifest.apply({'op': 'add', 'name': original_name, 'store': sanitized_name})
+    except Exception as e:
+        logger.warning(f"Could not load legacy name mappings for '{category}': {e}")
+
+def _new_manifest(category):
+    manifest = _CategoryManifest()
+    _load_legacy_mapping(category, manifest)
+    _manifests[category] = manifest
+    return manifest
+
+def _refresh(category):
+    manifest = _manifests.get(category)
+    path = _manifest_path(category)
+    try:
+        stat = os.stat(path)
+        size, file_id = stat.st_size, (stat.st_dev, stat.st_ino)
+    except FileNotFoundError:
+        size, file_id = 0, None
+
+    # a shrunk or different file means the category was deleted and recreated, or the manifest replaced
+    if manifest is None or size < manifest.offset or (manifest.offset and file_id != manifest.file_id):
+        manifest = _new_manifest(category)
+
+    if size == manifest.offset:
+        return manifest
+
+    with open(path, 'rb') as f:
+        # inode numbers get reused, so a recreated file is also told apart by its first line
+        if manifest.offset and f.readline() != manifest.header:
+            manifest = _new_manifest(category)
+        f.seek(manifest.offset)
+        data = f.read(size - manifest.offset)
+
+    if not manifest.offset:
+        manifest.header = data[:data.find(b'\n') + 1]
+    manifest.file_id = file_id
+
+    # only consume complete lines; a torn tail is picked up on the next refresh
+    complete = data.rfind(b'\n') + 1
+    for line in data[:complete].splitlines():
+        if not line.strip():
+            continue
+        try:
+            manifest.apply(json.loads(line))
+        except Exception as e:
+            logger.warning(f"Skipping unreadable manifest record in '{category}': {e}")
+    manifest.offset += complete
+    return manifest
+
+def fsync_directory(path):
+    """Makes renames and new files in path durable; directories can't be opened for fsync on Windows."""
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _append(category, record):
+    path = _manifest_path(category)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+    with open(path, 'a+b') as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            # lets a cached view notice that the category was deleted and its manifest started over
+            line = (json.dumps({'op': 'init', 'generation': uuid.uuid4().hex}) + '\n').encode('utf-8') + line
+        else:
+            f.seek(size - 1)
+            if f.read(1) != b'\n':
+                # end a line torn by a crash, or this record would be lost with it
+                line = b'\n' + line
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+    if size == 0:
+        fsync_directory(os.path.dirname(path))
+
+def record_document(category, name, store, content_hash=None, replaces=None, links=None):
+    """Points name at store; with replaces, every name of that store moves to store as well.
+
+    links names the stores holding the canonical copies of chunks that store
+    links to instead of embedding; they are kept while store has a document.
+    """
+    record = {'op': 'add', 'name': name, 'store': store, 'content_hash': content_hash}
+    if replaces:
+        record['replaces'] = replaces
+    if links:
+        record['links'] = sorted(links)
+    with _lock:
+        _append(category, record)
+        _refresh(category)
+    logger.info(f"Recorded manifest entry: {name} -> {store}" + (f" (replacing {replaces})" if replaces else ""))
+
+def remove_document(category, name):
+    """Drops a document from the manifest and returns the store it pointed to."""
+    with _lock:
+        store = _refresh(category).documents.get(name)
+        if store is not None:
+            _append(category, {'op': 'remove', 'name': name})
+            _refresh(category)
+    return store
+
+def forget(category):
+    """Drops the cached view of a category, e.g. after the category was deleted."""
+    with _lock:
+        _manifests.pop(category, None)
+
+def get_store_for_document(category, name):
+    with _lock:
+        return _refresh(category).documents.get(name)
+
+def get_store_for_hash(category, content_hash):
+    with _lock:
+        return _refresh(category).stores_by_hash.get(content_hash)
+
+def get_content_hash(category, store):
+    """Returns the content hash recorded for a store, or None (e.g. legacy filename-md5 stores)."""
+    with _lock:
+        for content_hash, hashed_store in _refresh(category).stores_by_hash.items():
+            if hashed_store == store:
+                return content_hash
+    return None
+
+def get_document_names(category, store):
+    with _lock:
+        return sorted(_refresh(category).names_by_store.get(store, ()))
+
+def get_original_name(category, store):
+    names = get_document_names(category, store)
+    return names[0] if names else store
+
+def is_store_referenced(category, store):
+    with _lock:
+        manifest = _refresh(category)
+        return store in manifest.names_by_store or store in manifest.linked_stores()
+
+def is_link_only(category, store):
+    """True if a store has no document left and is only kept for chunks other stores link to."""
+    with _lock:
+        manifest = _refresh(category)
+        return store not in manifest.names_by_store and store in manifest.linked_stores()
+
+def get_links(category, store):
+    """Returns the stores a store's linked chunks point into, whether or not it still has a document."""
+    with _lock:
+        return sorted(_refresh(category).links_by_store.get(store, ()))
+
+def get_referenced_stores(category):
+    """Returns (version, stores); the version changes with every record appended to the manifest."""
+    with _lock:
+        manifest = _refresh(category)
+        return (manifest.serial, manifest.offset), set(manifest.names_by_store) | manifest.linked_stores()
+
+def get_documents(category):
+    with _lock:
+        return dict(_refresh(category).documents)
@@ -1,29 +1,47 @@
 import logging
-import os
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_openai import ChatOpenAI
-from config import EMBEDDING_MODEL_NAME
+import threading
+from config import EMBEDDING_MODEL_NAME, LLM_BACKEND, LLM_REQUEST_TIMEOUT_SECONDS
 
 logger = logging.getLogger(__name__)
 
-def load_models():
-    try:
-        logger.info("Initializing embedding model...")
-        embeddings = HuggingFaceEmbeddings(
-            model_name=EMBEDDING_MODEL_NAME,
-            model_kwargs={'device': 'cuda'}
-        )
+# models are created on first use so workers that never embed or generate
+# (PDF serving, chat history) don't pay the import and load cost
+_embeddings = None
+_llm = None
+_lock = threading.Lock()
 
-        logger.info("Initializing LLM with GPT...")
-        llm = ChatOpenAI(model_name="gpt-4o-mini", temperature=0.1)
-
-        logger.info("Models loaded successfully.")
-        return embeddings, llm
-    except Exception as e:
-        logger.error(f"Failed to load models. Error: {e}")
-        exit()
+def get_embeddings():
+    global _embeddings
+    if _embeddings is None:
+        with _lock:
+            if _embeddings is None:
+                from langchain_huggingface import HuggingFaceEmbeddings
+                logger.info("Initializing embedding model...")
+                _embeddings = HuggingFaceEmbeddings(
+                    model_name=EMBEDDING_MODEL_NAME,
+                    model_kwargs={'device': 'cuda'}
+                )
+                logger.info("Embedding model loaded successfully.")
+    return _embeddings
 
-embeddings, llm = load_models()
+def get_llm():
+    global _llm
+    if _llm is None:
+        with _lock:
+            if _llm is None:
+                if LLM_BACKEND == 'stub':
+                    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+                    logger.info("Initializing local stub LLM...")
+                    _llm = FakeListChatModel(responses=["This is a stub answer.\nSOURCES: [1]"])
+                else:
+                    from langchain_openai import ChatOpenAI
+                    logger.info("Initializing LLM with GPT...")
+                    # retries are handled by the LLM gateway; the timeout stops a hung call
+                    # from holding a gateway slot for the client's 10-minute default
+                    _llm = ChatOpenAI(model_name="gpt-4o-mini", temperature=0.1, max_retries=0,
+                                      request_timeout=LLM_REQUEST_TIMEOUT_SECONDS)
+                logger.info("LLM loaded successfully.")
+    return _llm
 
 
 '''#For local LLm 
@@ -0,0 +1,111 @@
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+FINGERPRINT_BITS = 64
+SHINGLE_SIZE = 2
+
+# chunk metadata key holding the fingerprint computed at ingestion
+FINGERPRINT_KEY = 'simhash'
+
+def simhash(text):
+    """64-bit SimHash over word 2-shingles; near-identical texts differ in only a few bits."""
+    # whitespace tokens, since \w splits Bangla words at vowel signs
+    words = text.lower().split()
+    if len(words) >= SHINGLE_SIZE:
+        shingles = [' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)]
+    else:
+        shingles = words
+
+    weights = [0] * FINGERPRINT_BITS
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+        for bit in range(FINGERPRINT_BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+
+    fingerprint = 0
+    for bit, weight in enumerate(weights):
+        if weight > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+def fingerprint_of(doc):
+    # stores built before fingerprints were kept in metadata fall back to hashing the text
+    fingerprint = doc.metadata.get(FINGERPRINT_KEY)
+    return fingerprint if isinstance(fingerprint, int) else simhash(doc.page_content)
+
+
+class SimHashIndex:
+    """Finds fingerprints within max_distance bits using pigeonhole banding.
+
+    The 64 bits are split into max_distance + 1 bands; two fingerprints that
+    differ in at most max_distance bits must agree exactly on at least one band.
+    """
+
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        band_count = max_distance + 1
+        widths = [FINGERPRINT_BITS // band_count + (1 if i < FINGERPRINT_BITS % band_count else 0) for i in range(band_count)]
+        self._bands = []
+        offset = 0
+        for width in widths:
+            self._bands.append((offset, (1 << width) - 1))
+            offset += width
+        self._buckets = [{} for _ in self._bands]
+        self.size = 0
+
+    def add(self, fingerprint, ref):
+        for buckets, (offset, mask) in zip(self._buckets, self._bands):
+            buckets.setdefault(fingerprint >> offset & mask, []).append((fingerprint, ref))
+        self.size += 1
+
+    def find(self, fingerprint, accept=None):
+        """Returns the ref of a stored near-duplicate for which accept(ref) holds, or None."""
+        for buckets, (offset, mask) in zip(self._buckets, self._bands):
+            for candidate, ref in buckets.get(fingerprint >> offset & mask, ()):
+                if hamming_distance(candidate, fingerprint) <= self.max_distance and (accept is None or accept(ref)):
+                    return ref
+        return None
+
+
+def split_near_duplicates(chunks, max_distance):
+    """Drops chunks that nearly duplicate an earlier chunk of the same document; returns (kept, dropped count).
+
+    The kept chunk records the pages of the chunks it stands in for under
+    'duplicate_pages', so page filters still find them. Kept chunks also store
+    their fingerprint under FINGERPRINT_KEY, which collapse_near_duplicates and
+    the cross-document linking in utils.DuplicateLinker read back.
+    """
+    fingerprint_index = SimHashIndex(max_distance)
+    kept = []
+    for chunk in chunks:
+        fingerprint = simhash(chunk.page_content)
+        match = fingerprint_index.find(fingerprint)
+        if match is None:
+            fingerprint_index.add(fingerprint, len(kept))
+            chunk.metadata[FINGERPRINT_KEY] = fingerprint
+            kept.append(chunk)
+            continue
+        original = kept[match]
+        page = chunk.metadata.get('page')
+        if page != original.metadata.get('page') and page not in original.metadata.get('duplicate_pages', []):
+            original.metadata.setdefault('duplicate_pages', []).append(page)
+    return kept, len(chunks) - len(kept)
+
+def collapse_near_duplicates(docs, limit, max_distance):
+    """Keeps the best-ranked document of every near-duplicate group, up to limit documents."""
+    kept = []
+    fingerprints = []
+    for doc in docs:
+        fingerprint = fingerprint_of(doc)
+        if any(hamming_distance(fingerprint, other) <= max_distance for other in fingerprints):
+            continue
+        kept.append(doc)
+        fingerprints.append(fingerprint)
+        if len(kept) == limit:
+            break
+    return kept
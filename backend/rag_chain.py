@@ -1,35 +1,219 @@
-import os
 import logging
 import re
-import json
-from langchain.chains import LLMChain
-from langchain_community.vectorstores import FAISS
-from langchain.memory import ConversationBufferMemory
-from langchain.prompts import PromptTemplate
-from langchain.retrievers import ContextualCompressionRetriever
-from models import llm, embeddings
-from config import VECTOR_STORES_FOLDER, RETRIEVER_K
-from langchain.retrievers.document_compressors import FlashrankRerank
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.runnables import RunnablePassthrough
+import threading
+import time
+from models import get_llm, get_embeddings
+from config import (
+    RETRIEVER_K, CONTEXT_TOKEN_BUDGET, CONTEXT_BYTES_PER_TOKEN, BATCH_LLM_CONCURRENCY,
+    LLM_BATCH_ADMISSION_TIMEOUT_SECONDS, RERANK_BATCH_PAIRS,
+    NEAR_DUPLICATE_DETECTION, NEAR_DUPLICATE_MAX_HAMMING, NEAR_DUPLICATE_FETCH_FACTOR
+)
+from near_duplicates import collapse_near_duplicates
+from vector_index import get_category_index, resolve_sources
+from llm_gateway import get_llm_gateway, INTERACTIVE, BATCH, QueueFullError
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnablePassthrough, RunnableLambda
 from operator import itemgetter
-from langchain.schema.output_parser import StrOutputParser
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.documents import Document
 
 logger = logging.getLogger(__name__)
 
-def get_original_name_from_mapping(category, sanitized_name):
-    mapping_file = os.path.join(VECTOR_STORES_FOLDER, category, '_name_mapping.json')
-    
-    if not os.path.exists(mapping_file):
-        return sanitized_name
-    
-    try:
-        with open(mapping_file, 'r', encoding='utf-8') as f:
-            mappings = json.load(f)
-        return mappings.get(sanitized_name, sanitized_name)
-    except Exception as e:
-        logger.warning(f"Could not load name mappings: {e}")
-        return sanitized_name
+RERANK_TOP_N = 5
+
+_reranker = None
+_reranker_lock = threading.Lock()
+
+def search_diverse(category_index, query_vectors, filters=None, filter_ids=None):
+    """Searches with over-fetching and collapses near-duplicate hits down to RETRIEVER_K per query."""
+    if not NEAR_DUPLICATE_DETECTION:
+        return category_index.search(query_vectors, RETRIEVER_K, filters, filter_ids)
+
+    hits = category_index.search(query_vectors, RETRIEVER_K * NEAR_DUPLICATE_FETCH_FACTOR, filters, filter_ids)
+    results = []
+    for docs in hits:
+        diverse = collapse_near_duplicates(docs, RETRIEVER_K, NEAR_DUPLICATE_MAX_HAMMING)
+        unique_pages = len({(doc.metadata.get('source'), doc.metadata.get('page')) for doc in diverse})
+        logger.info(f"Retrieved {len(docs)} hits, kept {len(diverse)} after collapsing near-duplicates ({unique_pages} distinct pages).")
+        results.append(diverse)
+    return results
+
+def gated_llm(priority=INTERACTIVE):
+    # every LLM call goes through the gateway for admission control and retries;
+    # batch items wait for a queue place, interactive calls are rejected at once
+    admission_timeout = LLM_BATCH_ADMISSION_TIMEOUT_SECONDS if priority == BATCH else None
+    return RunnableLambda(lambda prompt_value: get_llm_gateway().call(
+        get_llm().invoke, prompt_value, priority=priority, admission_timeout=admission_timeout))
+
+def get_reranker():
+    global _reranker
+    if _reranker is None:
+        with _reranker_lock:
+            if _reranker is None:
+                from langchain.retrievers.document_compressors import FlashrankRerank
+                logger.info("Initializing FlashRank reranker...")
+                _reranker = FlashrankRerank(top_n=RERANK_TOP_N)
+    return _reranker
+
+def _score_pairs(ranker, pairs):
+    # mirrors the pairwise (ONNX) branch of Ranker.rerank in flashrank 0.2.10, for pairs
+    # from any number of queries; answer_questions_batch falls back to compress_documents
+    import numpy as np
+    encoded = ranker.tokenizer.encode_batch([list(pair) for pair in pairs])
+    onnx_input = {
+        "input_ids": np.array([e.ids for e in encoded], dtype=np.int64),
+        "attention_mask": np.array([e.attention_mask for e in encoded], dtype=np.int64),
+    }
+    token_type_ids = np.array([e.type_ids for e in encoded], dtype=np.int64)
+    if np.any(token_type_ids):
+        onnx_input["token_type_ids"] = token_type_ids
+    logits = ranker.session.run(None, onnx_input)[0]
+    if logits.shape[1] == 1:
+        return 1 / (1 + np.exp(-logits.flatten()))
+    exp_logits = np.exp(logits)
+    return exp_logits[:, 1] / np.sum(exp_logits, axis=1)
+
+def rerank_many(questions, docs_lists, batch_pairs=RERANK_BATCH_PAIRS):
+    """Reranks the hits of many questions in one pass, scoring batch_pairs (question, doc) pairs per model call.
+
+    Returns one reranked list per question, as compress_documents would. Falls
+    back to one compress_documents call per question for rerankers that are not
+    pairwise ONNX cross-encoders.
+    """
+    reranker = get_reranker()
+    ranker = reranker.client
+    if getattr(ranker, 'session', None) is None or getattr(ranker, 'llm_model', None) is not None:
+        return [list(reranker.compress_documents(docs, question)) if docs else [] for question, docs in zip(questions, docs_lists)]
+
+    # similar lengths share a call, so little of each call is padding
+    pairs = [(q, d) for q, docs in enumerate(docs_lists) for d in range(len(docs))]
+    pairs.sort(key=lambda pair: len(docs_lists[pair[0]][pair[1]].page_content))
+    scores = {}
+    for start in range(0, len(pairs), batch_pairs):
+        batch = pairs[start:start + batch_pairs]
+        batch_scores = _score_pairs(ranker, [(questions[q], docs_lists[q][d].page_content) for q, d in batch])
+        scores.update(zip(batch, batch_scores))
+
+    results = []
+    for q, docs in enumerate(docs_lists):
+        ranked = sorted(range(len(docs)), key=lambda d: scores[(q, d)], reverse=True)[:reranker.top_n]
+        results.append([
+            Document(page_content=docs[d].page_content, metadata={'id': d, 'relevance_score': scores[(q, d)], **docs[d].metadata})
+            for d in ranked if scores[(q, d)] >= reranker.score_threshold
+        ])
+    return results
+
+MIN_OVERLAP_CHARS = 20
+MAX_OVERLAP_CHARS = 1000
+MIN_TRUNCATED_TOKENS = 50
+
+def estimate_tokens(text):
+    # chunk sizes are budgeted in UTF-8 bytes, so estimate tokens the same way
+    return -(-len(text.encode('utf-8')) // CONTEXT_BYTES_PER_TOKEN)
+
+def _overlap_length(left, right):
+    # longest suffix of left that is also a prefix of right
+    for length in range(min(len(left), len(right), MAX_OVERLAP_CHARS), MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:length]):
+            return length
+    return 0
+
+def _merge_segment(segment, doc, score):
+    if doc.page_content in segment['text']:
+        segment['chunk_indices'].append(doc.metadata.get('chunk_index'))
+        segment['score'] = max(segment['score'], score)
+        return True
+
+    chunk_index = doc.metadata.get('chunk_index')
+    last_index = segment['chunk_indices'][-1]
+    overlap = _overlap_length(segment['text'], doc.page_content)
+    adjacent = isinstance(chunk_index, int) and isinstance(last_index, int) and chunk_index == last_index + 1
+    if not overlap and not adjacent:
+        return False
+
+    separator = '' if overlap else '\n\n'
+    segment['text'] += separator + doc.page_content[overlap:]
+    segment['chunk_indices'].append(chunk_index)
+    segment['score'] = max(segment['score'], score)
+    return True
+
+def _truncate_to_tokens(text, max_tokens):
+    encoded = text.encode('utf-8')[:max_tokens * CONTEXT_BYTES_PER_TOKEN]
+    truncated = encoded.decode('utf-8', errors='ignore')
+    cut = truncated.rfind(' ')
+    return (truncated[:cut] if cut > len(truncated) // 2 else truncated).rstrip() + ' ...'
+
+def pack_context(docs, token_budget=CONTEXT_TOKEN_BUDGET):
+    """Merges overlapping chunks from the same source page and fits them into the token budget.
+
+    The returned documents are what the prompt numbers as [Document N], so they
+    must also be what chat_handler maps citations back to.
+    """
+    if not docs:
+        return []
+
+    # group by source/page; each segment is ranked by the best rerank score of its own chunks
+    groups = {}
+    for rank, doc in enumerate(docs):
+        key = (doc.metadata.get('source'), doc.metadata.get('page'))
+        score = doc.metadata.get('relevance_score')
+        score = float(score) if score is not None else -rank
+        groups.setdefault(key, []).append((doc, score))
+
+    segments = []
+    for scored_docs in groups.values():
+        ordered = sorted(scored_docs, key=lambda pair: pair[0].metadata.get('chunk_index', 0) if isinstance(pair[0].metadata.get('chunk_index'), int) else 0)
+        current = None
+        for doc, score in ordered:
+            if current is None or not _merge_segment(current, doc, score):
+                current = {
+                    'text': doc.page_content,
+                    'metadata': doc.metadata,
+                    'chunk_indices': [doc.metadata.get('chunk_index')],
+                    'score': score,
+                }
+                segments.append(current)
+
+    segments.sort(key=lambda seg: seg['score'], reverse=True)
+
+    packed = []
+    used_tokens = 0
+    for segment in segments:
+        remaining = token_budget - used_tokens
+        text = segment['text']
+        tokens = estimate_tokens(text)
+        if tokens > remaining:
+            # always keep the best segment, even if it has to be cut down
+            if packed and remaining < MIN_TRUNCATED_TOKENS:
+                continue
+            text = _truncate_to_tokens(text, max(remaining, MIN_TRUNCATED_TOKENS))
+            tokens = estimate_tokens(text)
+
+        metadata = dict(segment['metadata'])
+        metadata['chunk_indices'] = segment['chunk_indices']
+        metadata['relevance_score'] = segment['score']
+        packed.append(Document(page_content=text, metadata=metadata))
+        used_tokens += tokens
+
+    original_tokens = sum(estimate_tokens(doc.page_content) for doc in docs)
+    logger.info(f"Packed {len(docs)} chunks into {len(packed)} context documents (~{used_tokens} of {original_tokens} tokens, budget {token_budget}).")
+    return packed
+
+def format_docs_with_numbers(docs):
+    formatted = []
+    for i, doc in enumerate(docs, 1):
+        source = doc.metadata.get('source', 'Unknown')
+        page = doc.metadata.get('page', 'N/A')
+        page_label = page + 1 if isinstance(page, int) else page
+        
+        formatted.append(
+            f"[Document {i}]\n"
+            f"Source: {source}\n"
+            f"Page: {page_label}\n"
+            f"Content: {doc.page_content}\n"
+            f"---"
+        )
+    return "\n\n".join(formatted)
 
 def detect_bangla_in_query(text):
     bangla_pattern = re.compile(r'[\u0980-\u09FF]')
@@ -53,82 +237,13 @@ def get_general_ai_chain():
         RunnablePassthrough.assign(
             context=itemgetter("question"))
         | prompt
-        | llm
+        | gated_llm()
         | StrOutputParser()
     )  
     return rag_chain
 
-def get_conversational_chain(category):
-    category_vs_path = os.path.join(VECTOR_STORES_FOLDER, category)
-    if not os.path.exists(category_vs_path):
-        logger.error(f"Vector store path for category '{category}' not found.")
-        return None
-    
-    all_items_in_category = os.listdir(category_vs_path)
-    document_folders = [
-        os.path.join(category_vs_path, d)
-        for d in all_items_in_category
-        if os.path.isdir(os.path.join(category_vs_path, d)) and not d.startswith('_')
-    ]
-
-    if not document_folders:
-        logger.warning(f"No valid document vector stores found in category '{category}'.")
-        return None
-
-    try:
-        logger.info(f"Found {len(document_folders)} vector store(s) for category '{category}'")
-        
-        all_vector_stores = []
-        for folder_path in document_folders:
-            folder_name = os.path.basename(folder_path)
-            logger.info(f"Loading vector store from: {folder_path}")
-            try:
-                vs = FAISS.load_local(
-                    folder_path, 
-                    embeddings, 
-                    allow_dangerous_deserialization=True
-                )
-                all_vector_stores.append(vs)
-                
-                # get original name for logging
-                original_name = get_original_name_from_mapping(category, folder_name)
-                logger.info(f"Successfully loaded: {original_name}")
-                
-            except Exception as e:
-                original_name = get_original_name_from_mapping(category, folder_name)
-                logger.error(f"Failed to load vector store from {original_name}: {e}")
-        
-        if not all_vector_stores:
-            logger.error("No vector stores could be loaded successfully.")
-            return None
-        
-        if len(all_vector_stores) == 1:
-            main_vs = all_vector_stores[0]
-            logger.info("Using single vector store.")
-        else:
-            logger.info(f"Merging {len(all_vector_stores)-1} additional vector store(s)...")
-            main_vs = all_vector_stores[0]
-            for i, vs in enumerate(all_vector_stores[1:], 1):
-                try:
-                    main_vs.merge_from(vs)
-                    logger.info(f"Successfully merged vector store {i}/{len(all_vector_stores)-1}")
-                except Exception as e:
-                    logger.error(f"Failed to merge vector store {i}: {e}")
-            logger.info("All vector stores merged successfully.")
-
-    except Exception as e:
-        logger.error(f"Failed to load or merge vector stores for category '{category}': {e}", exc_info=True)
-        return None
-
-    fetch_k_value = 30
-    top_n_value = 5
-    base_retriever = main_vs.as_retriever(search_type="similarity", search_kwargs={"k": RETRIEVER_K, "fetch_k": fetch_k_value})
-    reranker = FlashrankRerank(top_n=top_n_value)
-    compression_retriever = ContextualCompressionRetriever(
-        base_compressor=reranker, base_retriever=base_retriever
-    )
-
-    prompt = ChatPromptTemplate.from_messages([
+def get_rag_prompt():
+    return ChatPromptTemplate.from_messages([
         ("system", """You are a precise multilingual information extraction assistant that supports both English and Bangla (বাংলা). Use the conversation history for context and answer the user's question based on the provided text.
         
         Rules:
@@ -153,11 +268,31 @@ def get_conversational_chain(category):
         ("user", "Text: {context}\n\nQuestion: {question}\n\nDirect Answer:"),
     ])
 
+def get_conversational_chain(category, filters=None):
+    category_index = get_category_index(category)
+    if category_index is None:
+        return None
+
+    # filters are applied inside the FAISS search, not to its results
+    filter_ids = category_index.select_ids(filters)
+    if filters:
+        logger.info(f"Filtered retrieval in '{category}' to {len(filter_ids)} of {category_index.vector_store.index.ntotal} chunks: {filters}")
+
+    def retrieve_and_rerank(question):
+        query_vector = get_embeddings().embed_query(question)
+        docs = resolve_sources(category, search_diverse(category_index, [query_vector], filters, filter_ids)[0])
+        if not docs:
+            return []
+        return list(get_reranker().compress_documents(docs, question))
+
+    prompt = get_rag_prompt()
+
     def log_retrieved_docs(docs):
         try:
             separator = "=" * 50
             logger.info(separator)
-            logger.info("RETRIEVED AND RERANKED DOCUMENTS")
+            # logged after packing so the numbers match [Document N] in the prompt and sources
+            logger.info("PACKED CONTEXT DOCUMENTS")
             logger.info(separator)
             
             if not docs:
@@ -170,14 +305,15 @@ def get_conversational_chain(category):
                     page = doc.metadata.get('page', 'N/A')
                     language = doc.metadata.get('language', 'unknown')
                     
-                    logger.info(f"\nDocument {i+1}:")
+                    logger.info(f"\n[Document {i+1}]:")
                     logger.info(f"   Original Source: {source}")
                     logger.info(f"   Page: {page + 1 if isinstance(page, int) else page}")
+                    logger.info(f"   Chunks: {doc.metadata.get('chunk_indices')}")
                     logger.info(f"   Language: {language}")
                     logger.info(f"   Content Preview: {doc.page_content}...")
                 
                 logger.info(f"\nUnique PDFs accessed: {sources_seen}")
-                logger.info(f"Total documents retrieved: {len(docs)}")
+                logger.info(f"Total context documents: {len(docs)}")
             
             logger.info(separator)
         except Exception as e:
@@ -185,32 +321,81 @@ def get_conversational_chain(category):
         
         return docs
 
-    def format_docs_with_numbers(docs):
-        formatted = []
-        for i, doc in enumerate(docs, 1):
-            source = doc.metadata.get('source', 'Unknown')
-            page = doc.metadata.get('page', 'N/A')
-            page_label = page + 1 if isinstance(page, int) else page
-            
-            formatted.append(
-                f"[Document {i}]\n"
-                f"Source: {source}\n"
-                f"Page: {page_label}\n"
-                f"Content: {doc.page_content}\n"
-                f"---"
-            )
-        return "\n\n".join(formatted)
-
     rag_chain = (
         RunnablePassthrough.assign(
-            docs=itemgetter("question") | compression_retriever | log_retrieved_docs
+            docs=itemgetter("question") | RunnableLambda(retrieve_and_rerank) | RunnableLambda(pack_context) | log_retrieved_docs
         ).assign(
             context=lambda x: format_docs_with_numbers(x["docs"])
         ).assign(
             answer=(
                 prompt
-                | llm
+                | gated_llm()
             )
         )
     )
-    return rag_chain
\ No newline at end of file
+    return rag_chain
+
+def answer_questions_batch(category, questions, max_concurrency=BATCH_LLM_CONCURRENCY, filters=None):
+    """Answers many questions against one category with a single embedding and search pass.
+
+    Returns (results, timings) where each result holds either 'answer' and
+    'docs' or an 'error', in the order of the questions.
+    """
+    category_index = get_category_index(category)
+    if category_index is None:
+        return None, {}
+
+    timings = {}
+    results = [{'question': question} for question in questions]
+
+    started = time.perf_counter()
+    query_vectors = get_embeddings().embed_documents(questions)
+    timings['embed'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    hits = [resolve_sources(category, docs) for docs in search_diverse(category_index, query_vectors, filters)]
+    timings['search'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    try:
+        reranked = rerank_many(questions, hits)
+    except Exception as e:
+        # rerank one question at a time through flashrank's own API, as /chat does,
+        # so a failure only affects its own question
+        logger.error(f"Batched rerank failed, reranking questions one by one: {e}")
+        reranker = get_reranker()
+        reranked = []
+        for question, docs in zip(questions, hits):
+            try:
+                reranked.append(list(reranker.compress_documents(docs, question)) if docs else [])
+            except Exception as e:
+                logger.error(f"Rerank failed for batch question '{question[:20]}...': {e}")
+                reranked.append(None)
+    for result, docs in zip(results, reranked):
+        if docs is None:
+            result['error'] = "Failed to retrieve documents."
+        else:
+            result['docs'] = pack_context(docs)
+    timings['rerank'] = time.perf_counter() - started
+
+    pending = [result for result in results if 'error' not in result]
+    inputs = [
+        {"question": result['question'], "context": format_docs_with_numbers(result['docs'])}
+        for result in pending
+    ]
+
+    started = time.perf_counter()
+    answers = (get_rag_prompt() | gated_llm(BATCH)).batch(
+        inputs, config={"max_concurrency": max_concurrency}, return_exceptions=True
+    )
+    timings['generate'] = time.perf_counter() - started
+
+    for result, answer in zip(pending, answers):
+        if isinstance(answer, QueueFullError):
+            result['error'] = f"LLM queue is full. Retry after {answer.retry_after}s."
+        elif isinstance(answer, Exception):
+            logger.error(f"LLM call failed for batch question '{result['question'][:20]}...': {answer}")
+            result['error'] = "Failed to generate an answer."
+        else:
+            result['answer'] = answer
+    return results, timings
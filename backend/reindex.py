@@ -0,0 +1,281 @@
+"""Bulk (re)indexes every PDF under uploads/<category>/.
+
+Usage: python reindex.py <category> [<category> ...] [--workers N]
+                         [--embed-batch-size N] [--restart]
+
+Extraction, OCR and chunking run in a process pool and reuse the extraction
+cache. Chunks from many PDFs are embedded together in large batches in the
+main process, so the model is loaded once, and the vectors are written
+straight into the per-document stores without embedding again. Chunks that
+nearly duplicate a chunk of another PDF are linked to it instead of embedded.
+
+Progress is appended to a checkpoint in the category's vector store folder.
+An interrupted run picks up where it stopped when started again; the
+checkpoint is removed once a run finishes without failures. Use --restart
+to ignore an existing checkpoint.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from config import UPLOADS_FOLDER, VECTOR_STORES_FOLDER, EMBEDDING_MODEL_NAME, BULK_EMBED_BATCH_SIZE
+from models import get_embeddings
+from utils import build_chunks, index_chunks, dedup_chunks, compute_content_hash, remove_unreferenced_store, DuplicateLinker
+import manifest
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_FILENAME = '_reindex_checkpoint.jsonl'
+# a checkpoint only counts for the model it was built with
+RUN_KEY = f"model={EMBEDDING_MODEL_NAME}"
+
+
+class StageStats:
+    def __init__(self):
+        self.seconds = {'extract': 0.0, 'embed': 0.0, 'write': 0.0}
+        self.pdfs = 0
+        self.chunks = 0
+        self.deduplicated = 0
+        self.linked = 0
+        self.stores = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def report(self, wall_seconds):
+        def rate(count, seconds):
+            return f"{count / seconds:.2f}/s" if seconds > 0 else "n/a"
+        return (
+            f"{self.pdfs} PDF(s) in {wall_seconds:.1f}s ({rate(self.pdfs, wall_seconds)}), "
+            f"{self.skipped} skipped, {self.failed} failed, {self.deduplicated} near-duplicate chunks dropped, "
+            f"{self.linked} linked to other documents | "
+            f"extract {self.seconds['extract']:.1f} worker-s ({rate(self.pdfs, self.seconds['extract'])} per worker) | "
+            f"embed {self.seconds['embed']:.1f}s ({rate(self.chunks, self.seconds['embed'])} chunks) | "
+            f"write {self.seconds['write']:.1f}s ({rate(self.stores, self.seconds['write'])} stores)"
+        )
+
+
+def _checkpoint_path(category):
+    return os.path.join(VECTOR_STORES_FOLDER, category, CHECKPOINT_FILENAME)
+
+def load_checkpoint(category):
+    path = _checkpoint_path(category)
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('run_key') == RUN_KEY:
+                done.add(record['content_hash'])
+    return done
+
+def append_checkpoint(category, content_hash, pdf_name):
+    path = _checkpoint_path(category)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps({'run_key': RUN_KEY, 'content_hash': content_hash, 'name': pdf_name}, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def list_category_pdfs(category):
+    category_path = os.path.join(UPLOADS_FOLDER, category)
+    if not os.path.isdir(category_path):
+        return []
+    return sorted(
+        os.path.join(category_path, f) for f in os.listdir(category_path)
+        if f.lower().endswith('.pdf')
+    )
+
+def _extract_worker(pdf_path, content_hash):
+    started = time.perf_counter()
+    pdf_name, content_hash, chunks = build_chunks(pdf_path, content_hash)
+    return pdf_name, content_hash, chunks, time.perf_counter() - started
+
+
+class _EmbeddingBuffer:
+    """Collects chunks from several PDFs and embeds them in one call once the batch is full."""
+
+    def __init__(self, category, batch_size, stats, done_hashes):
+        self.category = category
+        self.batch_size = batch_size
+        self.stats = stats
+        self.done_hashes = done_hashes
+        self.pending = []  # (pdf_name, content_hash, chunks, linked chunks)
+        self.size = 0
+
+    def add(self, pdf_name, content_hash, chunks, linked):
+        self.pending.append((pdf_name, content_hash, chunks, linked))
+        self.size += len(chunks)
+        if self.size >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        texts = [chunk.page_content for _, _, chunks, _ in self.pending for chunk in chunks]
+
+        started = time.perf_counter()
+        try:
+            vectors = get_embeddings().embed_documents(texts)
+        except Exception as e:
+            # the PDFs stay out of the checkpoint, so the next run retries them
+            logger.error(f"Failed to embed a batch of {len(self.pending)} PDF(s): {e}", exc_info=True)
+            self.stats.failed += len(self.pending)
+            self.pending = []
+            self.size = 0
+            return
+        self.stats.seconds['embed'] += time.perf_counter() - started
+        self.stats.chunks += len(texts)
+
+        offset = 0
+        for pdf_name, content_hash, chunks, linked in self.pending:
+            pdf_vectors = vectors[offset:offset + len(chunks)]
+            offset += len(chunks)
+            started = time.perf_counter()
+            try:
+                index_chunks(chunks, self.category, pdf_name, content_hash, replace=True, vectors=pdf_vectors, linked=linked)
+                append_checkpoint(self.category, content_hash, pdf_name)
+                self.done_hashes.add(content_hash)
+                self.stats.stores += 1
+            except Exception as e:
+                logger.error(f"Failed to write vector store for '{pdf_name}': {e}", exc_info=True)
+                self.stats.failed += 1
+            self.stats.seconds['write'] += time.perf_counter() - started
+
+        self.pending = []
+        self.size = 0
+
+
+def reindex_category(category, workers, embed_batch_size, restart=False):
+    pdf_paths = list_category_pdfs(category)
+    if not pdf_paths:
+        logger.warning(f"No PDFs found for category '{category}'.")
+        return 0
+
+    if restart and os.path.exists(_checkpoint_path(category)):
+        os.remove(_checkpoint_path(category))
+    done_hashes = load_checkpoint(category)
+    if done_hashes:
+        logger.info(f"Resuming '{category}': {len(done_hashes)} PDF(s) already indexed by an earlier run.")
+
+    logger.info(f"Indexing {len(pdf_paths)} PDF(s) in '{category}' with {workers} worker(s)...")
+    stats = StageStats()
+    buffer = _EmbeddingBuffer(category, embed_batch_size, stats, done_hashes)
+    # one linker for the run, so PDFs are also linked to those extracted before them
+    linker = DuplicateLinker(category)
+    started = time.perf_counter()
+
+    def link(pdf_name, content_hash):
+        # a rebuilt store may have been published under a fresh folder name
+        store_name = manifest.get_store_for_hash(category, content_hash) or content_hash
+        previous_store = manifest.get_store_for_document(category, pdf_name)
+        if previous_store != store_name:
+            manifest.record_document(category, pdf_name, store_name, content_hash)
+            # e.g. a legacy filename-md5 store, which would otherwise be merged next to the new one
+            remove_unreferenced_store(category, previous_store)
+
+    def handle(pdf_name, content_hash, chunks):
+        stats.pdfs += 1
+        if not chunks:
+            logger.warning(f"No chunks created for '{pdf_name}'.")
+            stats.failed += 1
+            return
+        kept = dedup_chunks(chunks)
+        stats.deduplicated += len(chunks) - len(kept)
+        own, linked = linker.split(kept, content_hash)
+        stats.linked += len(linked)
+        buffer.add(pdf_name, content_hash, own, linked)
+
+    remaining = iter(pdf_paths)
+    submitted = set()
+    copies = []  # (pdf_name, content_hash) of identical copies of a PDF submitted in this run
+
+    def next_to_extract():
+        # hashing is cheap next to extraction, so finished PDFs are skipped before reaching a worker
+        for pdf_path in remaining:
+            pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
+            try:
+                content_hash = compute_content_hash(pdf_path)
+            except OSError as e:
+                logger.error(f"Failed to read {pdf_path}: {e}")
+                stats.failed += 1
+                continue
+            if content_hash in done_hashes:
+                link(pdf_name, content_hash)
+                stats.pdfs += 1
+                stats.skipped += 1
+            elif content_hash in submitted:
+                copies.append((pdf_name, content_hash))
+            else:
+                submitted.add(content_hash)
+                return pdf_path, content_hash
+        return None
+
+    # bound the number of in-flight PDFs so extracted text doesn't pile up in memory
+    in_flight = {}
+    last_report = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while len(in_flight) < workers * 2:
+            task = next_to_extract()
+            if task is None:
+                break
+            in_flight[executor.submit(_extract_worker, *task)] = task[0]
+
+        while in_flight:
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                pdf_path = in_flight.pop(future)
+                try:
+                    pdf_name, content_hash, chunks, seconds = future.result()
+                    stats.seconds['extract'] += seconds
+                    handle(pdf_name, content_hash, chunks)
+                except Exception as e:
+                    logger.error(f"Failed to extract {pdf_path}: {e}", exc_info=True)
+                    stats.failed += 1
+
+                task = next_to_extract()
+                if task is not None:
+                    in_flight[executor.submit(_extract_worker, *task)] = task[0]
+
+            if stats.pdfs - last_report >= 100:
+                last_report = stats.pdfs
+                logger.info(f"Progress '{category}': {stats.report(time.perf_counter() - started)}")
+
+    buffer.flush()
+
+    for pdf_name, content_hash in copies:
+        if content_hash in done_hashes:
+            link(pdf_name, content_hash)
+            stats.pdfs += 1
+            stats.skipped += 1
+        else:
+            # the copy that was extracted failed
+            stats.failed += 1
+
+    logger.info(f"Finished '{category}': {stats.report(time.perf_counter() - started)}")
+    if not stats.failed and os.path.exists(_checkpoint_path(category)):
+        os.remove(_checkpoint_path(category))
+    return stats.failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk (re)index the PDFs of one or more categories.")
+    parser.add_argument('categories', nargs='+')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--embed-batch-size', type=int, default=BULK_EMBED_BATCH_SIZE)
+    parser.add_argument('--restart', action='store_true', help="ignore an existing checkpoint")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    failed = 0
+    for category in args.categories:
+        failed += reindex_category(category, max(1, args.workers), max(1, args.embed_batch_size), args.restart)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
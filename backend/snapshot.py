@@ -0,0 +1,406 @@
+"""Exports a category to a single snapshot archive and imports it on another node.
+
+Usage: python snapshot.py export <category> <archive.tar|-> [--no-uploads] [--include-cache] [--include-history]
+       python snapshot.py import <archive.tar|-> [--category NAME] [--force]
+
+The archive is a plain tar written and read as a stream, so it can be piped
+between hosts ('-' for stdout/stdin). It holds a versioned header, the
+per-document stores, a precompacted category index, the document registry
+and optionally the PDFs, the extraction cache and the chat history, followed
+by SHA-256 checksums of every member.
+
+Import streams each member once into a staging folder inside the category
+(ignored by the loader), verifies the checksums and then publishes
+everything by rename. Queries load the precompacted index directly, so
+nothing is re-embedded or re-merged. A store already on the node is only
+reused if its files match the archive; otherwise the archive's store is
+published under a name derived from its checksums.
+
+Staging deliberately extracts to disk: publishing straight from the stream
+would expose stores before the trailing checksums are verified. The
+staging folder sits on the same filesystem, so each byte is still written
+only once and publishing is a rename, not a copy.
+"""
+import os
+import io
+import sys
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import sqlite3
+import tarfile
+import argparse
+from collections import Counter
+from datetime import datetime, timezone
+from config import UPLOADS_FOLDER, VECTOR_STORES_FOLDER, EMBEDDING_MODEL_NAME
+from database import DATABASE_NAME, init_db
+from vector_index import get_category_index, list_store_folders, evict_category, COMPACTED_FOLDER, COMPACTED_RANGES_FILENAME
+from utils import remove_unreferenced_store
+import extraction_cache
+import manifest
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 'chatwithpdfs-category-snapshot'
+SNAPSHOT_VERSION = 1
+HEADER_NAME = 'snapshot.json'
+CHECKSUMS_NAME = 'checksums.json'
+BLOCK_SIZE = 1024 * 1024
+
+
+class _HashingReader:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+
+class _SnapshotWriter:
+    def __init__(self, tar):
+        self.tar = tar
+        self.checksums = {}
+        self.bytes_written = 0
+
+    def add_bytes(self, name, data, checksum=True):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self.tar.addfile(info, io.BytesIO(data))
+        if checksum:
+            self.checksums[name] = hashlib.sha256(data).hexdigest()
+        self.bytes_written += len(data)
+
+    def add_json(self, name, content):
+        self.add_bytes(name, json.dumps(content, ensure_ascii=False).encode('utf-8'))
+
+    def add_jsonl(self, name, rows):
+        self.add_bytes(name, ''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows).encode('utf-8'))
+
+    def add_file(self, name, path):
+        info = self.tar.gettarinfo(path, arcname=name)
+        with open(path, 'rb') as f:
+            reader = _HashingReader(f)
+            self.tar.addfile(info, reader)
+        self.checksums[name] = reader.sha256.hexdigest()
+        self.bytes_written += info.size
+
+
+def _open_archive(path, mode):
+    # stream modes ('w|', 'r|*') never seek, so stdin/stdout and pipes work
+    if path == '-':
+        fileobj = sys.stdout.buffer if mode.startswith('w') else sys.stdin.buffer
+        return tarfile.open(fileobj=fileobj, mode=mode)
+    return tarfile.open(path, mode=mode)
+
+def export_category(category, archive_path, include_uploads=True, include_cache=False, include_history=False):
+    import faiss
+    import pickle
+
+    started = time.perf_counter()
+    category_index = get_category_index(category)
+    if category_index is None:
+        raise ValueError(f"Category '{category}' has no loadable vector stores.")
+
+    store_names = category_index.store_names
+    # the loader only logs stores it fails to load or merge, which would leave their documents out
+    listed = list_store_folders(category)
+    if sorted(listed) != sorted(store_names):
+        missing = sorted(set(listed) - set(store_names))
+        raise ValueError(f"Category '{category}' has {len(missing)} store(s) that failed to load, e.g. {missing[:3]}. "
+                         f"Check app.log and reindex them before exporting.")
+    documents = {name: store for name, store in manifest.get_documents(category).items() if store in store_names}
+    # store folders are not always named after the content hash (legacy or rebuilt stores)
+    content_hashes = {store: manifest.get_content_hash(category, store) for store in store_names}
+    header = {
+        'format': SNAPSHOT_FORMAT,
+        'version': SNAPSHOT_VERSION,
+        'category': category,
+        'embedding_model': EMBEDDING_MODEL_NAME,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'stores': len(store_names),
+        'documents': len(documents),
+    }
+
+    with _open_archive(archive_path, 'w|') as tar:
+        writer = _SnapshotWriter(tar)
+        writer.add_json(HEADER_NAME, header)
+
+        for store_name in store_names:
+            store_path = os.path.join(VECTOR_STORES_FOLDER, category, store_name)
+            for filename in sorted(os.listdir(store_path)):
+                writer.add_file(f"stores/{store_name}/{filename}", os.path.join(store_path, filename))
+
+        # the merged index in the FAISS.save_local layout
+        vector_store = category_index.vector_store
+        writer.add_bytes(f"{COMPACTED_FOLDER}/index.faiss", faiss.serialize_index(vector_store.index).tobytes())
+        writer.add_bytes(f"{COMPACTED_FOLDER}/index.pkl", pickle.dumps((vector_store.docstore, vector_store.index_to_docstore_id)))
+        writer.add_json(f"{COMPACTED_FOLDER}/{COMPACTED_RANGES_FILENAME}", {'stores': [list(r) for r in category_index.store_ranges]})
+
+        writer.add_jsonl('registry.jsonl', [
+            {'op': 'add', 'name': name, 'store': store, 'content_hash': content_hashes[store],
+             'links': manifest.get_links(category, store)}
+            for name, store in sorted(documents.items())
+        ])
+
+        if include_uploads:
+            # uploads keep the extension they were sent with, e.g. '.PDF'
+            category_upload_path = os.path.join(UPLOADS_FOLDER, category)
+            uploaded = {
+                os.path.splitext(f)[0]: f for f in (os.listdir(category_upload_path) if os.path.isdir(category_upload_path) else [])
+                if f.lower().endswith('.pdf')
+            }
+            for name in sorted(documents):
+                if name in uploaded:
+                    writer.add_file(f"uploads/{uploaded[name]}", os.path.join(category_upload_path, uploaded[name]))
+                else:
+                    logger.warning(f"PDF for '{name}' not found, exporting its index only.")
+
+        if include_cache:
+            writer.add_jsonl('extraction_cache.jsonl', extraction_cache.export_rows(sorted(h for h in content_hashes.values() if h)))
+
+        if include_history:
+            conn = sqlite3.connect(DATABASE_NAME)
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT sender, message, timestamp FROM chat_history WHERE category = ? ORDER BY timestamp ASC",
+                (category,)
+            )
+            writer.add_jsonl('chat_history.jsonl', [
+                {'sender': sender, 'message': message, 'timestamp': timestamp}
+                for sender, message, timestamp in cursor.fetchall()
+            ])
+            conn.close()
+
+        writer.add_json(CHECKSUMS_NAME, writer.checksums)
+
+    elapsed = time.perf_counter() - started
+    megabytes = writer.bytes_written / (1024 * 1024)
+    logger.info(f"Exported '{category}' ({len(store_names)} store(s), {len(documents)} document(s)) "
+                f"{megabytes:.1f} MB in {elapsed:.1f}s ({megabytes / elapsed if elapsed > 0 else 0:.1f} MB/s)")
+
+def _read_member_json(tar, member):
+    return json.loads(tar.extractfile(member).read().decode('utf-8'))
+
+def _safe_member_path(root, name):
+    path = os.path.normpath(os.path.join(root, name))
+    if os.path.isabs(name) or not path.startswith(os.path.normpath(root) + os.sep):
+        raise ValueError(f"Unsafe path in snapshot: {name}")
+    return path
+
+def _safe_category_name(name):
+    # the name becomes a folder under both data roots, so it must be a single path component
+    if (not isinstance(name, str) or not name or name in ('.', '..') or '/' in name or '\\' in name
+            or '\0' in name or os.path.basename(name) != name or os.path.isabs(name)):
+        raise ValueError(f"Unsafe category name in snapshot: {name!r}")
+    return name
+
+def _iter_jsonl(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def _stream_into_staging(tar, staging_path, actual):
+    """Writes every remaining member straight to the staging folder; returns (actual checksums, expected checksums, bytes)."""
+    expected = None
+    bytes_read = 0
+    # iterating the TarFile would restart at the header, which a stream can't seek back to
+    for member in iter(tar.next, None):
+        if member.name == CHECKSUMS_NAME:
+            expected = _read_member_json(tar, member)
+            continue
+        if not member.isfile():
+            continue
+        destination = _safe_member_path(staging_path, member.name)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        sha256 = hashlib.sha256()
+        source = tar.extractfile(member)
+        with open(destination, 'wb') as f:
+            for block in iter(lambda: source.read(BLOCK_SIZE), b''):
+                sha256.update(block)
+                f.write(block)
+        actual[member.name] = sha256.hexdigest()
+        bytes_read += member.size
+    return actual, expected, bytes_read
+
+def _archived_files(store_name, checksums):
+    prefix = f"stores/{store_name}/"
+    return {name[len(prefix):]: digest for name, digest in checksums.items() if name.startswith(prefix)}
+
+def _has_archived_files(store_path, store_name, checksums):
+    """True if a local store folder holds exactly the files the archive has for store_name."""
+    archived = _archived_files(store_name, checksums)
+    if not os.path.isdir(store_path) or sorted(os.listdir(store_path)) != sorted(archived):
+        return False
+    for filename, digest in archived.items():
+        sha256 = hashlib.sha256()
+        with open(os.path.join(store_path, filename), 'rb') as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+                sha256.update(block)
+        if sha256.hexdigest() != digest:
+            return False
+    return True
+
+def _publish(category, staging_path, checksums):
+    category_path = os.path.join(VECTOR_STORES_FOLDER, category)
+
+    # legacy stores are named after the file name, not the content, so a local
+    # store with an archive store's name may hold different vectors
+    renamed = {}
+    stores_path = os.path.join(staging_path, 'stores')
+    for store_name in os.listdir(stores_path) if os.path.isdir(stores_path) else []:
+        final_path = os.path.join(category_path, store_name)
+        if os.path.isdir(final_path):
+            if _has_archived_files(final_path, store_name, checksums):
+                logger.info(f"Store '{store_name}' already present with the same files, keeping the existing copy.")
+                continue
+            # named after the archived files, so importing the same snapshot again finds this copy
+            files_digest = hashlib.sha256(json.dumps(_archived_files(store_name, checksums), sort_keys=True).encode('utf-8')).hexdigest()
+            renamed[store_name] = f"{store_name}-{files_digest[:8]}"
+            final_path = os.path.join(category_path, renamed[store_name])
+            if _has_archived_files(final_path, store_name, checksums):
+                logger.info(f"Store '{store_name}' was already imported as '{renamed[store_name]}', keeping that copy.")
+                continue
+            if os.path.isdir(final_path):
+                raise ValueError(f"Store folders '{store_name}' and '{renamed[store_name]}' both hold other content.")
+            logger.warning(f"Store '{store_name}' already present with different content, publishing as '{renamed[store_name]}'.")
+        os.replace(os.path.join(stores_path, store_name), final_path)
+
+    # the compacted index must name the stores its vectors were published under
+    staged_compacted = os.path.join(staging_path, COMPACTED_FOLDER)
+    if renamed:
+        ranges_file = os.path.join(staged_compacted, COMPACTED_RANGES_FILENAME)
+        with open(ranges_file, 'r', encoding='utf-8') as f:
+            store_ranges = json.load(f)['stores']
+        with open(ranges_file, 'w', encoding='utf-8') as f:
+            json.dump({'stores': [[renamed.get(name, name), start, end] for name, start, end in store_ranges]}, f)
+
+    compacted_path = os.path.join(category_path, COMPACTED_FOLDER)
+    if os.path.isdir(compacted_path):
+        shutil.rmtree(compacted_path)
+    os.replace(staged_compacted, compacted_path)
+
+    uploads_path = os.path.join(staging_path, 'uploads')
+    if os.path.isdir(uploads_path):
+        category_upload_path = os.path.join(UPLOADS_FOLDER, category)
+        os.makedirs(category_upload_path, exist_ok=True)
+        for filename in os.listdir(uploads_path):
+            shutil.move(os.path.join(uploads_path, filename), os.path.join(category_upload_path, filename))
+
+    registry_file = os.path.join(staging_path, 'registry.jsonl')
+    if os.path.exists(registry_file):
+        for record in _iter_jsonl(registry_file):
+            store = renamed.get(record['store'], record['store'])
+            previous_store = manifest.get_store_for_document(category, record['name'])
+            if previous_store != store:
+                links = [renamed.get(target, target) for target in record.get('links', ())]
+                manifest.record_document(category, record['name'], store, record.get('content_hash'), links=links)
+                remove_unreferenced_store(category, previous_store)
+
+    cache_file = os.path.join(staging_path, 'extraction_cache.jsonl')
+    if os.path.exists(cache_file):
+        extraction_cache.import_rows(_iter_jsonl(cache_file))
+
+    history_file = os.path.join(staging_path, 'chat_history.jsonl')
+    if os.path.exists(history_file):
+        init_db()
+        conn = sqlite3.connect(DATABASE_NAME)
+        # skip messages already present so importing the same snapshot twice adds nothing
+        existing = Counter(conn.execute(
+            "SELECT sender, message, timestamp FROM chat_history WHERE category = ?", (category,)
+        ).fetchall())
+        rows = []
+        for row in _iter_jsonl(history_file):
+            key = (row['sender'], row['message'], row['timestamp'])
+            if existing[key]:
+                existing[key] -= 1
+            else:
+                rows.append((category, *key))
+        conn.executemany("INSERT INTO chat_history (category, sender, message, timestamp) VALUES (?, ?, ?, ?)", rows)
+        conn.commit()
+        conn.close()
+
+def import_snapshot(archive_path, category=None, force=False):
+    started = time.perf_counter()
+    with _open_archive(archive_path, 'r|*') as tar:
+        first = tar.next()
+        if first is None or first.name != HEADER_NAME:
+            raise ValueError("Not a category snapshot: missing header.")
+        header_bytes = tar.extractfile(first).read()
+        header = json.loads(header_bytes.decode('utf-8'))
+        if header.get('format') != SNAPSHOT_FORMAT or header.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot format {header.get('format')} v{header.get('version')}.")
+        if header.get('embedding_model') != EMBEDDING_MODEL_NAME and not force:
+            raise ValueError(f"Snapshot was built with '{header.get('embedding_model')}', "
+                             f"this node uses '{EMBEDDING_MODEL_NAME}'. Use --force to import anyway.")
+
+        category = _safe_category_name(category or header.get('category'))
+        category_path = os.path.join(VECTOR_STORES_FOLDER, category)
+        category_upload_path = os.path.join(UPLOADS_FOLDER, category)
+        # a failed import must not leave a new, empty category behind
+        created = [path for path in (category_path, category_upload_path) if not os.path.exists(path)]
+        staging_path = os.path.join(category_path, f"_import-{uuid.uuid4().hex[:8]}")
+        os.makedirs(staging_path)
+        try:
+            actual, expected, bytes_read = _stream_into_staging(
+                tar, staging_path, {HEADER_NAME: hashlib.sha256(header_bytes).hexdigest()})
+            if expected is None:
+                raise ValueError("Snapshot is truncated: checksums are missing.")
+            if actual != expected:
+                bad = sorted(name for name in set(actual) | set(expected) if actual.get(name) != expected.get(name))
+                raise ValueError(f"Checksum mismatch for {len(bad)} member(s), e.g. {bad[:3]}")
+            _publish(category, staging_path, expected)
+        except BaseException:
+            for path in created:
+                shutil.rmtree(path, ignore_errors=True)
+            if created:
+                manifest.forget(category)
+            raise
+        finally:
+            shutil.rmtree(staging_path, ignore_errors=True)
+
+    evict_category(category)
+    elapsed = time.perf_counter() - started
+    megabytes = bytes_read / (1024 * 1024)
+    logger.info(f"Imported '{category}' ({header['stores']} store(s), {header['documents']} document(s)) "
+                f"{megabytes:.1f} MB in {elapsed:.1f}s ({megabytes / elapsed if elapsed > 0 else 0:.1f} MB/s)")
+    return category
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import a category snapshot.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export')
+    export_parser.add_argument('category')
+    export_parser.add_argument('archive', help="archive path, or - for stdout")
+    export_parser.add_argument('--no-uploads', action='store_true', help="leave out the PDF files")
+    export_parser.add_argument('--include-cache', action='store_true', help="add the per-page extraction cache")
+    export_parser.add_argument('--include-history', action='store_true', help="add the category's chat history")
+
+    import_parser = subparsers.add_parser('import')
+    import_parser.add_argument('archive', help="archive path, or - for stdin")
+    import_parser.add_argument('--category', help="import under a different category name")
+    import_parser.add_argument('--force', action='store_true', help="import even if the embedding model differs")
+
+    args = parser.parse_args()
+    # keep stdout clean when the archive is streamed through it
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', stream=sys.stderr)
+
+    try:
+        if args.command == 'export':
+            export_category(args.category, args.archive, not args.no_uploads, args.include_cache, args.include_history)
+        else:
+            import_snapshot(args.archive, args.category, args.force)
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
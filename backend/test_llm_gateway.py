@@ -0,0 +1,130 @@
+import threading
+import time
+
+import pytest
+
+from llm_gateway import LLMGateway, QueueFullError, INTERACTIVE, BATCH
+
+
+class StubModelError(Exception):
+    pass
+
+
+def make_gateway(**kwargs):
+    options = dict(max_concurrency=1, max_queue_depth=4, max_batch_queue_depth=4, max_retries=2,
+                   backoff_base=0, backoff_max=0, retryable=lambda e: isinstance(e, StubModelError))
+    options.update(kwargs)
+    return LLMGateway(**options)
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out waiting for the gateway"
+        time.sleep(0.01)
+
+
+def start_call(gateway, fn, results, name, **kwargs):
+    def run():
+        try:
+            results[name] = gateway.call(fn, name, **kwargs)
+        except Exception as e:
+            results[name] = e
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def occupy(gateway, results):
+    """Holds the only concurrency slot until the returned event is set."""
+    release = threading.Event()
+    thread = start_call(gateway, lambda name: release.wait(5) and name, results, 'running')
+    wait_until(lambda: gateway.stats()['active'] == 1)
+    return release, thread
+
+
+def test_interactive_calls_are_served_before_queued_batch_calls():
+    gateway = make_gateway()
+    results, order = {}, []
+    release, running = occupy(gateway, results)
+
+    threads = [start_call(gateway, order.append, results, 'batch', priority=BATCH)]
+    wait_until(lambda: gateway.stats()['queued'] == 1)
+    threads.append(start_call(gateway, order.append, results, 'interactive', priority=INTERACTIVE))
+    wait_until(lambda: gateway.stats()['queued'] == 2)
+
+    release.set()
+    for thread in [running, *threads]:
+        thread.join(5)
+    assert order == ['interactive', 'batch']
+
+
+def test_full_queue_rejects_and_batch_cannot_use_interactive_places():
+    gateway = make_gateway(max_queue_depth=1, max_batch_queue_depth=1)
+    results = {}
+    release, running = occupy(gateway, results)
+
+    batch = start_call(gateway, lambda name: name, results, 'batch', priority=BATCH)
+    wait_until(lambda: gateway.stats()['queued_batch'] == 1)
+    with pytest.raises(QueueFullError):
+        gateway.call(lambda: None, priority=BATCH)
+
+    # the batch budget is full, but interactive callers still get their own place
+    gateway.check_admission(INTERACTIVE)
+    interactive = start_call(gateway, lambda name: name, results, 'interactive')
+    wait_until(lambda: gateway.stats()['queued_interactive'] == 1)
+    with pytest.raises(QueueFullError) as rejected:
+        gateway.call(lambda: None)
+    assert rejected.value.retry_after >= 1
+    assert gateway.stats()['rejected'] == 2
+
+    release.set()
+    for thread in (running, batch, interactive):
+        thread.join(5)
+    assert results['batch'] == 'batch' and results['interactive'] == 'interactive'
+
+
+def test_batch_call_waits_for_a_queue_place_when_given_a_timeout():
+    gateway = make_gateway(max_batch_queue_depth=1)
+    results = {}
+    release, running = occupy(gateway, results)
+    first = start_call(gateway, lambda name: name, results, 'first', priority=BATCH)
+    wait_until(lambda: gateway.stats()['queued_batch'] == 1)
+
+    with pytest.raises(QueueFullError):
+        gateway.call(lambda: None, priority=BATCH, admission_timeout=0.05)
+
+    second = start_call(gateway, lambda name: name, results, 'second', priority=BATCH, admission_timeout=5)
+    time.sleep(0.05)
+    assert 'second' not in results
+    release.set()
+    for thread in (running, first, second):
+        thread.join(5)
+    assert results['second'] == 'second'
+
+
+def test_retryable_errors_are_retried_and_others_raised():
+    gateway = make_gateway()
+    attempts = []
+
+    def flaky(fail_times, error):
+        attempts.append(error)
+        if len(attempts) <= fail_times:
+            raise error
+        return 'answer'
+
+    assert gateway.call(flaky, 2, StubModelError()) == 'answer'
+    assert len(attempts) == 3
+
+    attempts.clear()
+    with pytest.raises(StubModelError):
+        gateway.call(flaky, 5, StubModelError())
+    assert len(attempts) == 3
+
+    attempts.clear()
+    with pytest.raises(ValueError):
+        gateway.call(flaky, 5, ValueError())
+    assert len(attempts) == 1
+
+    stats = gateway.stats()
+    assert (stats['completed'], stats['failed'], stats['retries']) == (1, 2, 4)
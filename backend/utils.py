@@ -1,60 +1,158 @@
 import os
 import logging
 import re
-from langchain_community.document_loaders import PyMuPDFLoader
-from langchain_community.vectorstores import FAISS
-from langchain.schema import Document
-from models import embeddings
-from config import VECTOR_STORES_FOLDER,TESSERACT_PATH, OCR_LANGUAGES, OCR_CONFIDENCE_THRESHOLD, POPPLER_PATH
+from langchain_core.documents import Document
+from models import get_embeddings
+from config import (
+    VECTOR_STORES_FOLDER,TESSERACT_PATH, OCR_LANGUAGES, OCR_CONFIDENCE_THRESHOLD, OCR_DPI, POPPLER_PATH,
+    NEAR_DUPLICATE_DETECTION, NEAR_DUPLICATE_MAX_HAMMING
+)
+import manifest
+import extraction_cache
+from near_duplicates import split_near_duplicates, SimHashIndex, FINGERPRINT_KEY
+from vector_index import list_store_folders, get_store_fingerprints, LINKS_FILENAME
 import hashlib
 import json
-import pytesseract
-from pdf2image import convert_from_path
-from PIL import Image
+import shutil
+import time
+import uuid
+import threading
 
 logger = logging.getLogger(__name__)
-pytesseract.pytesseract.tesseract_cmd = TESSERACT_PATH
 
-def sanitize_filename(filename):
-    # create a hash of the original filename
-    filename_hash = hashlib.md5(filename.encode('utf-8')).hexdigest()
-    return filename_hash
+_ocr_backend = None
+_ocr_lock = threading.Lock()
+
+def get_ocr_backend():
+    # pytesseract and pdf2image are only needed for scanned PDFs
+    global _ocr_backend
+    if _ocr_backend is None:
+        with _ocr_lock:
+            if _ocr_backend is None:
+                import pytesseract
+                from pdf2image import convert_from_path
+                pytesseract.pytesseract.tesseract_cmd = TESSERACT_PATH
+                _ocr_backend = (pytesseract, convert_from_path)
+    return _ocr_backend
+
+def load_pdf_pages(pdf_path, pdf_name, content_hash):
+    """Returns one Document per page with the PyMuPDF text, using the extraction cache."""
+    settings = extraction_cache.PYMUPDF_SETTINGS
+    pages, page_count = extraction_cache.get_pages(content_hash, 'pymupdf', settings)
+
+    if page_count is None:
+        from langchain_community.document_loaders import PyMuPDFLoader
+        loaded = PyMuPDFLoader(pdf_path).load()
+        pages = {doc.metadata.get('page', i): doc.page_content for i, doc in enumerate(loaded)}
+        page_count = len(loaded)
+        extraction_cache.put_pages(content_hash, 'pymupdf', settings, pages, page_count)
+    else:
+        logger.info(f"Loaded text of {page_count} page(s) of '{pdf_name}' from the extraction cache.")
+
+    return [
+        Document(page_content=pages.get(page, ''), metadata={'source': pdf_name, 'page': page, 'extraction_method': 'pymupdf'})
+        for page in range(page_count)
+    ]
+
+def compute_content_hash(pdf_path, block_size=1024 * 1024):
+    # hash the file bytes so renamed copies of the same PDF share one store
+    sha256 = hashlib.sha256()
+    with open(pdf_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def _fsync_store(path):
+    # the manifest record is fsynced, so the files it points at must be on disk first
+    for filename in os.listdir(path):
+        with open(os.path.join(path, filename), 'r+b') as f:
+            os.fsync(f.fileno())
+    manifest.fsync_directory(path)
+
+def save_vector_store_atomically(vector_store, category, store_name, replace=False, links=None):
+    """Publishes a store by rename and returns the folder name it was published under.
+
+    A published store is never changed in place. With replace=True an existing
+    store is kept and the new one gets a fresh folder name; it replaces the
+    old one when the manifest is pointed at it. links are the store's chunks
+    served by a near-duplicate in another store, saved next to the index.
+    """
+    category_path = os.path.join(VECTOR_STORES_FOLDER, category)
+    # the manifest only points at a store once it is published; the underscore
+    # prefix also keeps half-written stores out of list_store_folders without one
+    tmp_path = os.path.join(category_path, f"_tmp-{store_name}-{uuid.uuid4().hex[:8]}")
+
+    os.makedirs(category_path, exist_ok=True)
+    vector_store.save_local(tmp_path)
+    if links:
+        with open(os.path.join(tmp_path, LINKS_FILENAME), 'w', encoding='utf-8') as f:
+            json.dump([{'page_content': chunk.page_content, 'metadata': chunk.metadata} for chunk in links], f, ensure_ascii=False)
+    _fsync_store(tmp_path)
+
+    if replace and os.path.isdir(os.path.join(category_path, store_name)):
+        store_name = f"{store_name}-{uuid.uuid4().hex[:8]}"
+    final_path = os.path.join(category_path, store_name)
 
-def save_name_mapping(category, sanitized_name, original_name):
-    mapping_file = os.path.join(VECTOR_STORES_FOLDER, category, '_name_mapping.json')
-    
-    # load existing mappings
-    mappings = {}
-    if os.path.exists(mapping_file):
-        try:
-            with open(mapping_file, 'r', encoding='utf-8') as f:
-                mappings = json.load(f)
-        except Exception as e:
-            logger.warning(f"Could not load existing mappings: {e}")
-    
-    # add new mapping
-    mappings[sanitized_name] = original_name
-    
-    # save mappings
     try:
-        os.makedirs(os.path.dirname(mapping_file), exist_ok=True)
-        with open(mapping_file, 'w', encoding='utf-8') as f:
-            json.dump(mappings, f, ensure_ascii=False, indent=2)
-        logger.info(f"Saved name mapping: {sanitized_name} -> {original_name}")
-    except Exception as e:
-        logger.error(f"Failed to save name mapping: {e}")
+        os.replace(tmp_path, final_path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if os.path.isdir(final_path):
+            logger.info(f"Vector store '{store_name}' was published concurrently. Discarding duplicate.")
+            return store_name
+        raise
+    manifest.fsync_directory(category_path)
+    return store_name
+
+def remove_stale_temp_stores(category, max_age_seconds=3600):
+    category_path = os.path.join(VECTOR_STORES_FOLDER, category)
+    if not os.path.isdir(category_path):
+        return
+    now = time.time()
+    for entry in os.listdir(category_path):
+        path = os.path.join(category_path, entry)
+        if entry.startswith('_tmp-') and os.path.isdir(path) and now - os.path.getmtime(path) > max_age_seconds:
+            shutil.rmtree(path, ignore_errors=True)
+            logger.info(f"Removed stale temporary vector store: {path}")
+
+def remove_unreferenced_store(category, store_name):
+    if not store_name or manifest.is_store_referenced(category, store_name):
+        return False
+    store_path = os.path.join(VECTOR_STORES_FOLDER, category, store_name)
+    if not os.path.isdir(store_path):
+        return False
+    shutil.rmtree(store_path)
+    logger.info(f"Removed unreferenced vector store: {store_path}")
+    # stores kept only for the chunks this one linked to may go now as well
+    for target in manifest.get_links(category, store_name):
+        remove_unreferenced_store(category, target)
+    return True
+
+def render_pdf_page(pdf_path, page_number, dpi):
+    """Renders a 1-based page to PNG bytes, or returns None if the page does not exist."""
+    import fitz
+    with fitz.open(pdf_path) as pdf:
+        if not 1 <= page_number <= pdf.page_count:
+            return None
+        return pdf.load_page(page_number - 1).get_pixmap(dpi=dpi).tobytes('png')
+
+def get_pdf_page_text(pdf_path, page_number):
+    import fitz
+    with fitz.open(pdf_path) as pdf:
+        if not 1 <= page_number <= pdf.page_count:
+            return None
+        return pdf.load_page(page_number - 1).get_text()
 
 def detect_language(text):
     bangla_pattern = re.compile(r'[\u0980-\u09FF]')
     return bool(bangla_pattern.search(text))
 
-def is_pdf_scanned(pdf_path, sample_pages=3):
+def is_pdf_scanned(documents, sample_pages=3):
     try:
-        loader = PyMuPDFLoader(pdf_path)
-        documents = loader.load()
-        
         # Check first N pages
         pages_to_check = min(sample_pages, len(documents))
+        if not pages_to_check:
+            return False
         total_text_length = 0
         
         for i in range(pages_to_check):
@@ -71,35 +169,64 @@ def is_pdf_scanned(pdf_path, sample_pages=3):
     except Exception as e:
         logger.error(f"Error checking if PDF is scanned: {e}")
         return False
+
+def _ocr_image(pytesseract, image):
+    # Perform OCR with confidence scores
+    ocr_data = pytesseract.image_to_data(
+        image, 
+        lang=OCR_LANGUAGES,
+        output_type=pytesseract.Output.DICT
+    )
+    
+    # Filter by confidence and reconstruct text
+    page_text = []
+    for i, conf in enumerate(ocr_data['conf']):
+        if int(conf) > OCR_CONFIDENCE_THRESHOLD:
+            text = ocr_data['text'][i]
+            if text.strip():
+                page_text.append(text)
     
-def extract_text_with_ocr(pdf_path, pdf_name):
+    return ' '.join(page_text)
+
+def _missing_page_runs(cached_pages, page_count):
+    # group missing 0-based pages into contiguous (first, last) runs for pdf2image
+    runs = []
+    for page in range(page_count):
+        if page in cached_pages:
+            continue
+        if runs and runs[-1][1] == page - 1:
+            runs[-1][1] = page
+        else:
+            runs.append([page, page])
+    return runs
+    
+def extract_text_with_ocr(pdf_path, pdf_name, content_hash, page_count):
     try:
         logger.info(f"Starting OCR extraction for '{pdf_name}'...")
-        
-        # Convert PDF pages to images
-        images = convert_from_path(pdf_path, dpi=300, poppler_path=POPPLER_PATH)  # Higher DPI = better quality
+        settings = extraction_cache.ocr_settings_key()
+        pages, _ = extraction_cache.get_pages(content_hash, 'ocr', settings)
+        runs = _missing_page_runs(pages, page_count)
+        if pages:
+            logger.info(f"Reusing cached OCR text for {len(pages)}/{page_count} page(s) of '{pdf_name}'.")
+
+        if runs:
+            pytesseract, convert_from_path = get_ocr_backend()
+        for first, last in runs:
+            # Convert PDF pages to images
+            images = convert_from_path(
+                pdf_path, dpi=OCR_DPI, poppler_path=POPPLER_PATH,  # Higher DPI = better quality
+                first_page=first + 1, last_page=last + 1
+            )
+            for page_num, image in enumerate(images, first):
+                logger.info(f"Processing page {page_num + 1}/{page_count} with OCR...")
+                pages[page_num] = _ocr_image(pytesseract, image)
+                # cache every page so an interrupted run resumes where it stopped
+                extraction_cache.put_pages(content_hash, 'ocr', settings, {page_num: pages[page_num]})
+        extraction_cache.put_pages(content_hash, 'ocr', settings, {}, page_count)
         
         documents = []
-        for page_num, image in enumerate(images):
-            logger.info(f"Processing page {page_num + 1}/{len(images)} with OCR...")
-            
-            # Perform OCR with confidence scores
-            ocr_data = pytesseract.image_to_data(
-                image, 
-                lang=OCR_LANGUAGES,
-                output_type=pytesseract.Output.DICT
-            )
-            
-            # Filter by confidence and reconstruct text
-            page_text = []
-            for i, conf in enumerate(ocr_data['conf']):
-                if int(conf) > OCR_CONFIDENCE_THRESHOLD:
-                    text = ocr_data['text'][i]
-                    if text.strip():
-                        page_text.append(text)
-            
-            text_content = ' '.join(page_text)
-            
+        for page_num in range(page_count):
+            text_content = pages.get(page_num, '')
             if text_content.strip():
                 doc = Document(
                     page_content=text_content,
@@ -120,6 +247,141 @@ def extract_text_with_ocr(pdf_path, pdf_name):
     except Exception as e:
         logger.error(f"OCR extraction failed for '{pdf_name}': {e}")
         return []
+
+def extract_documents(pdf_path, pdf_name, content_hash):
+    documents = load_pdf_pages(pdf_path, pdf_name, content_hash)
+    if is_pdf_scanned(documents):
+        logger.info(f"Detected scanned PDF '{pdf_name}'. Using OCR for text extraction...")
+        return extract_text_with_ocr(pdf_path, pdf_name, content_hash, len(documents))
+    logger.info(f"Loaded text-based PDF '{pdf_name}'.")
+    return documents
+
+def build_chunks(pdf_path, content_hash=None):
+    """Extracts and chunks one PDF; safe to run in a worker process."""
+    pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    content_hash = content_hash or compute_content_hash(pdf_path)
+    documents = extract_documents(pdf_path, pdf_name, content_hash)
+    if not documents:
+        logger.warning(f"No text could be extracted from '{pdf_name}'.")
+        return pdf_name, content_hash, []
+    # pass documents and OG pdf_name to preserve metadata
+    return pdf_name, content_hash, chunk_semantically(documents, pdf_name)
+
+def dedup_chunks(chunks):
+    """Drops chunks that nearly duplicate an earlier chunk of the same PDF before they are embedded."""
+    if not NEAR_DUPLICATE_DETECTION or not chunks:
+        return chunks
+    kept, dropped = split_near_duplicates(chunks, NEAR_DUPLICATE_MAX_HAMMING)
+    if dropped:
+        logger.info(f"Dropped {dropped} of {len(chunks)} chunks ({dropped / len(chunks):.0%}) as near-duplicates within the document.")
+    return kept
+
+class DuplicateLinker:
+    """Matches new chunks against the chunks already embedded in a category's stores.
+
+    A chunk that nearly duplicates a chunk of another document (e.g. the same
+    passage in two editions of a PDF) is linked to that document's store
+    instead of being embedded again. Chunks of documents split earlier with
+    the same linker are matched as well, so one linker can serve a bulk run.
+    """
+
+    def __init__(self, category):
+        self.category = category
+        # refs are (content hash, fingerprint, whether it comes from a store published before this linker)
+        self.fingerprint_index = SimHashIndex(NEAR_DUPLICATE_MAX_HAMMING)
+        self.split_hashes = set()
+        self.claimed = {}  # content hash -> SimHashIndex of its published chunks that others link to
+        if not NEAR_DUPLICATE_DETECTION:
+            return
+        for store_name in list_store_folders(category):
+            # stores are matched by content hash, which survives rebuilds; legacy stores have none
+            content_hash = manifest.get_content_hash(category, store_name)
+            if content_hash is None:
+                continue
+            try:
+                fingerprints = get_store_fingerprints(category, store_name)
+            except Exception as e:
+                logger.warning(f"Not linking to store '{store_name}', its chunks could not be read: {e}")
+                continue
+            for fingerprint in fingerprints:
+                self.fingerprint_index.add(fingerprint, (content_hash, fingerprint, True))
+
+    def split(self, chunks, content_hash):
+        """Returns (chunks to embed, [(linked chunk, content hash of the document holding its near-duplicate)])."""
+        if not NEAR_DUPLICATE_DETECTION:
+            return chunks, []
+        self.split_hashes.add(content_hash)
+        claimed = self.claimed.get(content_hash)
+
+        def accept(ref):
+            target_hash, _, published = ref
+            # once a document is split again its rebuilt store replaces the published one
+            return target_hash != content_hash and not (published and target_hash in self.split_hashes)
+
+        own, linked = [], []
+        for chunk in chunks:
+            fingerprint = chunk.metadata.get(FINGERPRINT_KEY)
+            target = None
+            # a rebuilt store keeps the chunks other documents were already linked to
+            if isinstance(fingerprint, int) and not (claimed and claimed.find(fingerprint) is not None):
+                target = self.fingerprint_index.find(fingerprint, accept=accept)
+            if target is None:
+                own.append(chunk)
+                continue
+            target_hash, target_fingerprint, published = target
+            if published:
+                self.claimed.setdefault(target_hash, SimHashIndex(NEAR_DUPLICATE_MAX_HAMMING)).add(target_fingerprint, True)
+            linked.append((chunk, target_hash))
+        if linked and not own:
+            # a store needs at least one vector of its own
+            own.append(linked.pop(0)[0])
+        for chunk in own:
+            if isinstance(chunk.metadata.get(FINGERPRINT_KEY), int):
+                self.fingerprint_index.add(chunk.metadata[FINGERPRINT_KEY], (content_hash, chunk.metadata[FINGERPRINT_KEY], False))
+        if linked:
+            logger.info(f"Linked {len(linked)} of {len(chunks)} chunks to near-duplicates in other documents instead of embedding them.")
+        return own, linked
+
+def index_chunks(chunks, category, pdf_name, content_hash, replace=False, vectors=None, linked=()):
+    """Builds and publishes the store for one PDF; pass vectors to reuse embeddings computed in bulk.
+
+    linked are (chunk, content hash) pairs from DuplicateLinker.split; a
+    chunk whose document has since been deleted is embedded after all.
+    """
+    from langchain_community.vectorstores import FAISS
+    previous_store = manifest.get_store_for_document(category, pdf_name)
+    existing_store = manifest.get_store_for_hash(category, content_hash)
+
+    links, link_targets, orphaned = [], set(), []
+    for chunk, target_hash in linked:
+        target = manifest.get_store_for_hash(category, target_hash)
+        if target is None:
+            orphaned.append(chunk)
+        else:
+            links.append(chunk)
+            link_targets.add(target)
+
+    chunks = list(chunks) + orphaned
+    texts = [chunk.page_content for chunk in chunks]
+    if vectors is None:
+        vectors = get_embeddings().embed_documents(texts)
+    elif orphaned:
+        vectors = list(vectors) + get_embeddings().embed_documents([chunk.page_content for chunk in orphaned])
+    vector_store = FAISS.from_embeddings(
+        list(zip(texts, vectors)), get_embeddings(), metadatas=[chunk.metadata for chunk in chunks]
+    )
+    store_name = save_vector_store_atomically(vector_store, category, content_hash, replace=replace, links=links)
+
+    # the manifest record is the commit point for the upload; a rebuilt store
+    # takes over the old one's names in the same record, so queries never see
+    # the document missing or twice
+    replaces = existing_store if existing_store != store_name else None
+    manifest.record_document(category, pdf_name, store_name, content_hash, replaces=replaces, links=link_targets)
+    for old_store in {previous_store, existing_store} - {store_name}:
+        remove_unreferenced_store(category, old_store)
+    
+    logger.info(f"Saved vector store for '{pdf_name}' (as {store_name}) with {len(chunks)} semantic chunks"
+                + (f" and {len(links)} linked to {len(link_targets)} other store(s)." if links else "."))
        
 def chunk_semantically(documents, pdf_name, chunk_size=2000, chunk_overlap=300):
     chunks = []
@@ -190,44 +452,31 @@ def chunk_semantically(documents, pdf_name, chunk_size=2000, chunk_overlap=300):
 
 def process_and_index_pdf(pdf_path, category):
     pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
-    
-    # sanitize the filename for the vector store path
-    sanitized_name = sanitize_filename(pdf_name)
-    vector_store_path = os.path.join(VECTOR_STORES_FOLDER, category, sanitized_name)
-
-    if os.path.exists(vector_store_path):
-        logger.info(f"Vector store for '{pdf_name}' already exists. Skipping.")
-        return
 
     try:
-        logger.info(f"Processing '{pdf_name}' for category '{category}' with semantic chunking...")
+        # vector stores are addressed by PDF content, not by filename
+        content_hash = compute_content_hash(pdf_path)
+        previous_store = manifest.get_store_for_document(category, pdf_name)
+        existing_store = manifest.get_store_for_hash(category, content_hash) or content_hash
 
-        if is_pdf_scanned(pdf_path):
-            logger.info(f"Detected scanned PDF '{pdf_name}'. Using OCR for text extraction...")
-            documents = extract_text_with_ocr(pdf_path, pdf_name)
-            if not documents:
-                logger.warning(f"OCR extraction yielded no documents for '{pdf_name}'. Skipping.")
+        if os.path.isdir(os.path.join(VECTOR_STORES_FOLDER, category, existing_store)):
+            if previous_store == existing_store:
+                logger.info(f"Vector store for '{pdf_name}' already exists. Skipping.")
                 return
-        else:
-            logger.info(f"Loading text-based PDF '{pdf_name}'...")
-            loader = PyMuPDFLoader(pdf_path)
-            documents = loader.load()
+            logger.info(f"Content of '{pdf_name}' is already indexed as '{existing_store}'. Linking instead of re-embedding.")
+            manifest.record_document(category, pdf_name, existing_store, content_hash)
+            remove_unreferenced_store(category, previous_store)
+            return
 
-        # pass documents and OG pdf_name to preserve metadata
-        chunks = chunk_semantically(documents, pdf_name)  # Use OG name in metadata
+        logger.info(f"Processing '{pdf_name}' for category '{category}' with semantic chunking...")
+        _, _, chunks = build_chunks(pdf_path, content_hash)
         
         if not chunks:
             logger.warning(f"No chunks created for '{pdf_name}'.")
             return
         
-        vector_store = FAISS.from_documents(chunks, embeddings)
-        os.makedirs(vector_store_path, exist_ok=True)
-        vector_store.save_local(vector_store_path)
-        
-        # save the name mapping
-        save_name_mapping(category, sanitized_name, pdf_name)
-        
-        logger.info(f"Saved vector store for '{pdf_name}' (as {sanitized_name}) with {len(chunks)} semantic chunks.")
+        own, linked = DuplicateLinker(category).split(dedup_chunks(chunks), content_hash)
+        index_chunks(own, category, pdf_name, content_hash, linked=linked)
 
     except Exception as e:
-        logger.error(f"Failed to process {pdf_name}. Error: {e}")
\ No newline at end of file
+        logger.error(f"Failed to process {pdf_name}. Error: {e}")
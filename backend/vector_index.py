@@ -0,0 +1,415 @@
+import os
+import json
+import logging
+import pickle
+import threading
+from collections import defaultdict
+from config import VECTOR_STORES_FOLDER, NEAR_DUPLICATE_MAX_HAMMING
+from models import get_embeddings
+from near_duplicates import FINGERPRINT_KEY, SimHashIndex, fingerprint_of
+from langchain_core.documents import Document
+import manifest
+
+logger = logging.getLogger(__name__)
+
+COMPACTED_FOLDER = '_compacted'
+COMPACTED_RANGES_FILENAME = 'stores.json'
+# chunks of a store that are served by a near-duplicate in another store instead of a vector of their own
+LINKS_FILENAME = 'links.json'
+
+# category -> (store signature, CategoryIndex)
+_category_stores = {}
+_category_locks = defaultdict(threading.Lock)
+# (category, store) -> (index mtime, fingerprints of the store's chunks)
+_store_fingerprints = {}
+_fingerprints_lock = threading.Lock()
+
+def list_store_folders(category):
+    """Lists the stores the manifest points at, so a manifest record publishes or retires a store."""
+    category_vs_path = os.path.join(VECTOR_STORES_FOLDER, category)
+    if not os.path.isdir(category_vs_path):
+        return []
+    while True:
+        version, referenced = manifest.get_referenced_stores(category)
+        folders = sorted(
+            d for d in os.listdir(category_vs_path)
+            if os.path.isdir(os.path.join(category_vs_path, d)) and not d.startswith('_')
+        )
+        if not referenced:
+            # a category without any manifest or legacy name mapping
+            return folders
+        # a store is retired only after the manifest stops pointing at it, so an
+        # unchanged manifest means the listing saw all of its stores
+        if manifest.get_referenced_stores(category)[0] == version:
+            return [d for d in folders if d in referenced]
+
+def _store_signature(category, store_names):
+    # rebuilt stores get a fresh folder name, but a deleted and re-uploaded PDF
+    # is published again under the same content-hash name, so include the index mtime as well;
+    # a store whose last document was deleted stays only to serve chunks linked to it
+    signature = []
+    for store_name in store_names:
+        index_file = os.path.join(VECTOR_STORES_FOLDER, category, store_name, 'index.faiss')
+        mtime = os.path.getmtime(index_file) if os.path.exists(index_file) else 0
+        signature.append((store_name, mtime, manifest.is_link_only(category, store_name)))
+    return tuple(signature)
+
+def load_store_links(category, store_name):
+    """Returns the chunks a store links to a near-duplicate in another store, as Documents."""
+    links_file = os.path.join(VECTOR_STORES_FOLDER, category, store_name, LINKS_FILENAME)
+    if not os.path.exists(links_file):
+        return []
+    with open(links_file, 'r', encoding='utf-8') as f:
+        return [Document(page_content=link['page_content'], metadata=link['metadata']) for link in json.load(f)]
+
+def get_store_fingerprints(category, store_name):
+    """Returns the fingerprints of the chunks embedded in a store, read from its docstore without loading FAISS.
+
+    Published stores never change in place, so they are cached by index mtime.
+    Stores built before fingerprints were kept in metadata yield none.
+    """
+    index_file = os.path.join(VECTOR_STORES_FOLDER, category, store_name, 'index.pkl')
+    mtime = os.path.getmtime(index_file)
+    with _fingerprints_lock:
+        cached = _store_fingerprints.get((category, store_name))
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(index_file, 'rb') as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    fingerprints = []
+    for docstore_id in index_to_docstore_id.values():
+        doc = docstore.search(docstore_id)
+        if not isinstance(doc, str) and isinstance(doc.metadata.get(FINGERPRINT_KEY), int):
+            fingerprints.append(doc.metadata[FINGERPRINT_KEY])
+    with _fingerprints_lock:
+        _store_fingerprints[(category, store_name)] = (mtime, fingerprints)
+    return fingerprints
+
+def load_vector_store(folder_path):
+    from langchain_community.vectorstores import FAISS
+    return FAISS.load_local(
+        folder_path,
+        get_embeddings(),
+        allow_dangerous_deserialization=True
+    )
+
+class CategoryIndex:
+    """The merged FAISS store of a category plus per-vector metadata used for pre-filtering.
+
+    Stores are merged in order, so each document store owns a contiguous range
+    of FAISS ids; page and language are read once from the docstore. A chunk
+    also matches the pages of the near-duplicates dropped in its favour.
+    Every chunk is tagged with the store that holds it under 'store'.
+
+    links maps a store to (the stores it links into, its linked chunks). A
+    linked chunk has no vector of its own: it is served by the near-duplicate
+    it was matched to, and filters and citations see it as a chunk of its own
+    store. Stores in hidden have no document left and only serve linked chunks.
+    """
+
+    def __init__(self, vector_store, store_ranges, links=None, hidden=()):
+        import numpy as np
+
+        self.vector_store = vector_store
+        self.store_ranges = store_ranges
+        total = vector_store.index.ntotal
+        self.store_names = [store_name for store_name, _, _ in store_ranges]
+        self.store_of_id = np.full(total, -1, dtype=np.int32)
+        for position, (_, start, end) in enumerate(store_ranges):
+            self.store_of_id[start:end] = position
+        self.hidden_positions = {i for i, name in enumerate(self.store_names) if name in hidden}
+        self.hidden = np.isin(self.store_of_id, list(self.hidden_positions))
+
+        self.pages = np.full(total, -1, dtype=np.int32)
+        self.languages = np.empty(total, dtype=object)
+        self.duplicate_pages = []  # (faiss id, page)
+        self.docs = [None] * total
+        for faiss_id in range(total):
+            doc = vector_store.docstore.search(vector_store.index_to_docstore_id[faiss_id])
+            if isinstance(doc, str):
+                continue
+            self.docs[faiss_id] = doc
+            doc.metadata['store'] = self.store_names[self.store_of_id[faiss_id]]
+            page = doc.metadata.get('page')
+            if isinstance(page, int):
+                self.pages[faiss_id] = page
+            self.duplicate_pages.extend((faiss_id, p) for p in doc.metadata.get('duplicate_pages', ()) if isinstance(p, int))
+            self.languages[faiss_id] = doc.metadata.get('language')
+
+        self.linked = defaultdict(list)  # faiss id -> [(store position, linked chunk)]
+        self._resolve_links(links or {})
+        self._unfiltered = np.flatnonzero(self._with_links(~self.hidden, None)).astype(np.int64) if self.hidden_positions else None
+
+    def _resolve_links(self, links):
+        positions = {name: i for i, name in enumerate(self.store_names)}
+        targets = {positions[t] for store_targets, _ in links.values() for t in store_targets if t in positions}
+        fingerprint_index = SimHashIndex(NEAR_DUPLICATE_MAX_HAMMING)
+        for faiss_id, doc in enumerate(self.docs):
+            if doc is not None and self.store_of_id[faiss_id] in targets:
+                fingerprint_index.add(fingerprint_of(doc), faiss_id)
+
+        for store_name, (store_targets, docs) in links.items():
+            position = positions[store_name]
+            allowed = {positions[t] for t in store_targets if t in positions}
+            unresolved = 0
+            for doc in docs:
+                faiss_id = fingerprint_index.find(fingerprint_of(doc), accept=lambda i: self.store_of_id[i] in allowed)
+                if faiss_id is None:
+                    unresolved += 1
+                    continue
+                doc.metadata['store'] = store_name
+                self.linked[faiss_id].append((position, doc))
+            if unresolved:
+                logger.warning(f"{unresolved} of {len(docs)} linked chunk(s) of store '{store_name}' have no near-duplicate "
+                               f"left in {sorted(store_targets)}; reindex its document to embed them.")
+
+    def _matches(self, position, metadata, filters):
+        if not filters:
+            return True
+        if filters.get('stores') is not None and self.store_names[position] not in filters['stores']:
+            return False
+        if filters.get('pages') is not None:
+            first, last = filters['pages']
+            pages = [metadata.get('page'), *metadata.get('duplicate_pages', ())]
+            if not any(isinstance(p, int) and first <= p <= last for p in pages):
+                return False
+        if filters.get('language') is not None and metadata.get('language') != filters['language']:
+            return False
+        return True
+
+    def _with_links(self, mask, filters):
+        # a vector also matches when a chunk linked to it does
+        for faiss_id, entries in self.linked.items():
+            if not mask[faiss_id] and any(position not in self.hidden_positions and self._matches(position, doc.metadata, filters)
+                                          for position, doc in entries):
+                mask[faiss_id] = True
+        return mask
+
+    def select_ids(self, filters):
+        """Returns the FAISS ids matching the filters, or None when nothing is filtered."""
+        import numpy as np
+
+        if not filters:
+            return self._unfiltered
+        mask = ~self.hidden
+        if filters.get('stores') is not None:
+            positions = [i for i, name in enumerate(self.store_names) if name in filters['stores']]
+            mask &= np.isin(self.store_of_id, positions)
+        if filters.get('pages') is not None:
+            first, last = filters['pages']
+            page_mask = (self.pages >= first) & (self.pages <= last)
+            for faiss_id, page in self.duplicate_pages:
+                if first <= page <= last:
+                    page_mask[faiss_id] = True
+            mask &= page_mask
+        if filters.get('language') is not None:
+            mask &= self.languages == filters['language']
+        return np.flatnonzero(self._with_links(mask, filters)).astype(np.int64)
+
+    def present(self, faiss_id, filters=None):
+        """Returns the chunk a hit stands for: its own, or a chunk linked to it when only that one matches."""
+        doc = self.docs[faiss_id]
+        position = self.store_of_id[faiss_id]
+        if position not in self.hidden_positions and self._matches(position, doc.metadata, filters):
+            return doc
+        for linked_position, linked_doc in self.linked.get(faiss_id, ()):
+            if linked_position not in self.hidden_positions and self._matches(linked_position, linked_doc.metadata, filters):
+                return linked_doc
+        return doc
+
+    def search(self, query_vectors, k, filters=None, ids=None):
+        """Searches the ids selected by the filters and returns, per query, the chunks the hits stand for."""
+        if ids is None:
+            ids = self.select_ids(filters)
+        return [
+            [self.present(faiss_id, filters) for faiss_id in row if self.docs[faiss_id] is not None]
+            for row in search_ids(self.vector_store, query_vectors, k, ids)
+        ]
+
+
+def resolve_filters(category, raw_filters):
+    """Validates request filters and maps document names to their stores.
+
+    Accepts {"documents": [names], "pages": [first, last] (1-based, inclusive),
+    "language": "english" | "bangla"} and raises ValueError on bad input,
+    including an empty document list and names that are not in the category.
+    """
+    if not raw_filters:
+        return None
+    if not isinstance(raw_filters, dict):
+        raise ValueError("'filters' must be an object.")
+
+    filters = {}
+    documents = raw_filters.get('documents')
+    if documents is not None:
+        if not isinstance(documents, list) or not all(isinstance(d, str) for d in documents):
+            raise ValueError("'filters.documents' must be a list of file names.")
+        if not documents:
+            # an empty store set would silently answer without any context
+            raise ValueError("'filters.documents' must name at least one document.")
+        stores = {d: manifest.get_store_for_document(category, os.path.splitext(d)[0] if d.lower().endswith('.pdf') else d) for d in documents}
+        unknown = [d for d, store in stores.items() if store is None]
+        if unknown:
+            raise ValueError(f"Unknown document(s) in category '{category}': {', '.join(unknown)}")
+        filters['stores'] = set(stores.values())
+
+    pages = raw_filters.get('pages')
+    if pages is not None:
+        if (not isinstance(pages, list) or len(pages) != 2 or not all(isinstance(p, int) for p in pages)
+                or pages[0] < 1 or pages[1] < pages[0]):
+            raise ValueError("'filters.pages' must be [first, last] with 1 <= first <= last.")
+        # page metadata is 0-based
+        filters['pages'] = (pages[0] - 1, pages[1] - 1)
+
+    language = raw_filters.get('language')
+    if language is not None:
+        if language not in ('english', 'bangla'):
+            raise ValueError("'filters.language' must be 'english' or 'bangla'.")
+        filters['language'] = language
+
+    return filters or None
+
+def resolve_sources(category, docs):
+    """Points each document's 'source' at a current name of its store.
+
+    A store is shared by every upload with the same content but its chunks
+    keep the name of the first one, which may since have been deleted.
+    """
+    resolved = []
+    for doc in docs:
+        names = manifest.get_document_names(category, doc.metadata.get('store'))
+        if names and doc.metadata.get('source') not in names:
+            doc = Document(page_content=doc.page_content, metadata={**doc.metadata, 'source': names[0]})
+        resolved.append(doc)
+    return resolved
+
+def _load_links(category, store_names):
+    """Returns (links, hidden) for CategoryIndex; a store whose links can't be read is served without them."""
+    links = {}
+    for store_name in store_names:
+        try:
+            docs = load_store_links(category, store_name)
+        except Exception as e:
+            logger.error(f"Failed to load the linked chunks of store '{store_name}': {e}")
+            continue
+        if docs:
+            links[store_name] = (manifest.get_links(category, store_name), docs)
+    hidden = {store_name for store_name in store_names if manifest.is_link_only(category, store_name)}
+    return links, hidden
+
+def _load_compacted(category, store_names):
+    """Loads a precompacted category index (e.g. from a snapshot) if it still covers exactly these stores."""
+    compacted_path = os.path.join(VECTOR_STORES_FOLDER, category, COMPACTED_FOLDER)
+    ranges_file = os.path.join(compacted_path, COMPACTED_RANGES_FILENAME)
+    if not os.path.exists(ranges_file):
+        return None
+    try:
+        with open(ranges_file, 'r', encoding='utf-8') as f:
+            store_ranges = [tuple(r) for r in json.load(f)['stores']]
+        if sorted(name for name, _, _ in store_ranges) != sorted(store_names):
+            return None
+        # a store rebuilt after compaction makes the compacted index stale
+        compacted_mtime = os.path.getmtime(ranges_file)
+        for store_name in store_names:
+            if os.path.getmtime(os.path.join(VECTOR_STORES_FOLDER, category, store_name, 'index.faiss')) > compacted_mtime:
+                return None
+        vector_store = load_vector_store(compacted_path)
+        logger.info(f"Loaded precompacted index for category '{category}' ({len(store_ranges)} store(s)).")
+        return CategoryIndex(vector_store, store_ranges, *_load_links(category, store_names))
+    except Exception as e:
+        logger.warning(f"Ignoring precompacted index for category '{category}': {e}")
+        return None
+
+def _load_and_merge(category, store_names):
+    compacted = _load_compacted(category, store_names)
+    if compacted is not None:
+        return compacted
+
+    logger.info(f"Found {len(store_names)} vector store(s) for category '{category}'")
+
+    loaded = []
+    for store_name in store_names:
+        folder_path = os.path.join(VECTOR_STORES_FOLDER, category, store_name)
+        original_name = manifest.get_original_name(category, store_name)
+        logger.info(f"Loading vector store from: {folder_path}")
+        try:
+            loaded.append((store_name, load_vector_store(folder_path)))
+            logger.info(f"Successfully loaded: {original_name}")
+        except Exception as e:
+            logger.error(f"Failed to load vector store from {original_name}: {e}")
+
+    if not loaded:
+        logger.error("No vector stores could be loaded successfully.")
+        return None
+
+    first_name, main_vs = loaded[0]
+    store_ranges = [(first_name, 0, main_vs.index.ntotal)]
+    if len(loaded) == 1:
+        logger.info("Using single vector store.")
+        return CategoryIndex(main_vs, store_ranges, *_load_links(category, [first_name]))
+
+    logger.info(f"Merging {len(loaded)-1} additional vector store(s)...")
+    for i, (store_name, vs) in enumerate(loaded[1:], 1):
+        start = main_vs.index.ntotal
+        try:
+            main_vs.merge_from(vs)
+            store_ranges.append((store_name, start, main_vs.index.ntotal))
+            logger.info(f"Successfully merged vector store {i}/{len(loaded)-1}")
+        except Exception as e:
+            logger.error(f"Failed to merge vector store {i}: {e}")
+    logger.info("All vector stores merged successfully.")
+    return CategoryIndex(main_vs, store_ranges, *_load_links(category, [name for name, _, _ in store_ranges]))
+
+def get_category_index(category):
+    """Returns the CategoryIndex for a category, loading it only when its stores changed."""
+    if not os.path.exists(os.path.join(VECTOR_STORES_FOLDER, category)):
+        logger.error(f"Vector store path for category '{category}' not found.")
+        return None
+
+    store_names = list_store_folders(category)
+    if not store_names:
+        logger.warning(f"No valid document vector stores found in category '{category}'.")
+        return None
+
+    with _category_locks[category]:
+        signature = _store_signature(category, store_names)
+        cached = _category_stores.get(category)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+        try:
+            category_index = _load_and_merge(category, store_names)
+        except Exception as e:
+            logger.error(f"Failed to load or merge vector stores for category '{category}': {e}", exc_info=True)
+            return None
+
+        if category_index is not None:
+            _category_stores[category] = (signature, category_index)
+        return category_index
+
+def search_ids(vector_store, query_vectors, k, ids=None):
+    """Runs one FAISS search for all query vectors and returns the FAISS ids of the hits per query.
+
+    When ids is given only those vectors are searched (an ID-selector pre-filter).
+    """
+    import faiss
+    import numpy as np
+
+    if ids is not None:
+        if len(ids) == 0:
+            return [[] for _ in query_vectors]
+        k = min(k, len(ids))
+
+    vectors = np.asarray(query_vectors, dtype=np.float32)
+    if getattr(vector_store, '_normalize_L2', False):
+        faiss.normalize_L2(vectors)
+    if ids is None:
+        _, indices = vector_store.index.search(vectors, k)
+    else:
+        params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(ids))
+        _, indices = vector_store.index.search(vectors, k, params=params)
+    return [[int(idx) for idx in row if idx != -1] for row in indices]
+
+def evict_category(category):
+    with _category_locks[category]:
+        _category_stores.pop(category, None)
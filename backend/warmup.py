@@ -0,0 +1,77 @@
+import os
+import time
+import logging
+import sqlite3
+import threading
+from config import VECTOR_STORES_FOLDER, WARMUP_TOP_CATEGORIES
+from database import DATABASE_NAME
+from models import get_embeddings
+from rag_chain import get_reranker
+from vector_index import get_category_index
+
+logger = logging.getLogger(__name__)
+
+# component -> 'pending' | 'ready' | 'failed'
+_status = {}
+_status_lock = threading.Lock()
+_warmup_thread = None
+
+def _set_status(component, state):
+    with _status_lock:
+        _status[component] = state
+
+def get_most_used_categories(limit):
+    if not os.path.exists(VECTOR_STORES_FOLDER):
+        return []
+    existing = {d for d in os.listdir(VECTOR_STORES_FOLDER) if os.path.isdir(os.path.join(VECTOR_STORES_FOLDER, d))}
+    try:
+        conn = sqlite3.connect(DATABASE_NAME)
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT category FROM chat_history WHERE sender = 'user' GROUP BY category ORDER BY COUNT(*) DESC"
+        )
+        ranked = [row[0] for row in cursor.fetchall()]
+        conn.close()
+    except Exception as e:
+        logger.warning(f"Could not rank categories by usage: {e}")
+        ranked = []
+    return [category for category in ranked if category in existing][:limit]
+
+def _run_warmup(top_categories):
+    started = time.perf_counter()
+    steps = [('embeddings', get_embeddings), ('reranker', get_reranker)]
+    steps += [(f"category:{category}", lambda c=category: get_category_index(c)) for category in get_most_used_categories(top_categories)]
+
+    for component, _ in steps:
+        _set_status(component, 'pending')
+
+    for component, load in steps:
+        step_started = time.perf_counter()
+        try:
+            load()
+            _set_status(component, 'ready')
+            logger.info(f"Warm-up: {component} ready in {time.perf_counter() - step_started:.2f}s")
+        except Exception as e:
+            _set_status(component, 'failed')
+            logger.error(f"Warm-up: failed to load {component}: {e}", exc_info=True)
+
+    logger.info(f"Warm-up finished in {time.perf_counter() - started:.2f}s")
+
+def start_warmup(top_categories=WARMUP_TOP_CATEGORIES):
+    global _warmup_thread
+    if _warmup_thread is not None:
+        return
+    _set_status('embeddings', 'pending')
+    _warmup_thread = threading.Thread(target=_run_warmup, args=(top_categories,), name='warmup', daemon=True)
+    _warmup_thread.start()
+
+def get_readiness():
+    """Returns (ready, component states). Without a warm-up the app is ready and loads lazily."""
+    with _status_lock:
+        components = dict(_status)
+    ready = (
+        all(state != 'pending' for state in components.values())
+        and components.get('embeddings') != 'failed'
+        and components.get('reranker') != 'failed'
+    )
+    return ready, components